@@ -0,0 +1,130 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Deterministic local stand-ins for Gemini and Vertex AI Search.
+# They look like the real responses as far as our code is concerned, with
+# configurable latency and output size. Install them with install().
+
+import json
+import random
+import time
+from types import SimpleNamespace
+
+WORDS = ('alphabet google search revenue cloud growth the a of and to in is for with on our users '
+         'advertising youtube platform investment model business services').split()
+
+
+def make_text(words, seed):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def part_text(part):
+    """The text of a prompt part as the model sees it"""
+    try:
+        return part.text
+    except Exception:
+        return str(part)
+
+
+class FakeModel:
+    """Stand-in for GenerativeModel.generate_content.
+
+    Args:
+        first_chunk_latency (float): Seconds until the first chunk (or the whole response without streaming)
+        chunk_latency (float): Seconds between two streamed chunks
+        words (int): Length of an answer in words
+        words_per_chunk (int): Words per streamed chunk
+        grounding_chunks (int): Number of grounding documents when called with tools
+    """
+
+    def __init__(self, first_chunk_latency=0.3, chunk_latency=0.02, words=150, words_per_chunk=8, grounding_chunks=5):
+        self.first_chunk_latency = first_chunk_latency
+        self.chunk_latency = chunk_latency
+        self.words = words
+        self.words_per_chunk = words_per_chunk
+        self.grounding_chunks = grounding_chunks
+        self.calls = 0
+
+    def output(self, contents):
+        prompt = ' '.join(part_text(c) for c in contents) if isinstance(contents, list) else str(contents)
+        if 'For each of them, identify the intent' in prompt:
+            conversations = json.loads(prompt.split('Conversations:\n')[-1].split('Your result:')[0])
+            return '```json\n' + json.dumps([{'conversation': c['conversation'], 'intent': 'alphabet' if 'alphabet' in c['query'].lower() else 'other'}
+                                             for c in conversations]) + '\n```'
+        if 'identify the intent' in prompt:
+            intent = 'alphabet' if 'alphabet' in prompt.split('Latest query:')[-1].lower() else 'other'
+            return f'```json\n{{\n   "intent": "{intent}"\n}}\n```'
+        return make_text(self.words, len(prompt))
+
+    def candidates(self, tools):
+        chunks = [SimpleNamespace(retrieved_context=SimpleNamespace(title=f'report-{i}.pdf', uri=f'gs://fake-bucket/report-{i}.pdf'))
+                  for i in range(self.grounding_chunks if tools else 0)]
+        return [SimpleNamespace(grounding_metadata=SimpleNamespace(grounding_chunks=chunks))]
+
+    def response(self, text, prompt_tokens, candidates):
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4,
+                                total_token_count=prompt_tokens + len(text) // 4)
+        return SimpleNamespace(text=text, candidates=candidates, usage_metadata=usage)
+
+    def generate_content(self, contents, stream=False, tools=None, **kwargs):
+        self.calls += 1
+        text = self.output(contents)
+        prompt_tokens = len(str(contents)) // 4
+        if not stream:
+            time.sleep(self.first_chunk_latency)
+            return self.response(text, prompt_tokens, self.candidates(tools))
+        return self.stream(text, prompt_tokens, tools)
+
+    def stream(self, text, prompt_tokens, tools):
+        words = text.split(' ')
+        time.sleep(self.first_chunk_latency)
+        for i in range(0, len(words), self.words_per_chunk):
+            if i:
+                time.sleep(self.chunk_latency)
+            last = i + self.words_per_chunk >= len(words)
+            piece = ' '.join(words[i:i + self.words_per_chunk]) + ('' if last else ' ')
+            yield self.response(piece, prompt_tokens, self.candidates(tools) if last else self.candidates(None))
+
+
+class FakeSearchClient:
+    """Stand-in for discoveryengine SearchServiceClient.search"""
+
+    def __init__(self, latency=0.2, results=10, snippet_words=40, summary_words=80):
+        self.latency = latency
+        self.results = results
+        self.snippet_words = snippet_words
+        self.summary_words = summary_words
+
+    def search(self, request):
+        time.sleep(self.latency)
+        results = []
+        for i in range(self.results):
+            struct_data = {'link': f'gs://fake-bucket/report-{i}.pdf',
+                           'snippets': [{'snippet': make_text(self.snippet_words, i)}],
+                           'extractive_answers': [{'pageNumber': str(i + 1), 'content': make_text(self.snippet_words, i + 100)}],
+                           'extractive_segments': []}
+            results.append(SimpleNamespace(document=SimpleNamespace(derived_struct_data=struct_data)))
+        summary = make_text(self.summary_words, 7) + ' - first point - second point 1. one 2. two'
+        return SimpleNamespace(summary=SimpleNamespace(summary_text=summary), results=results)
+
+
+def install(model=None, search_client=None):
+    """Replaces the real clients with fakes, process wide"""
+    from util.llm import get_model
+    from util.rag import get_search_client, get_storage_client, get_grounding_tool
+    get_model.set(model or FakeModel())
+    get_search_client.set(search_client or FakeSearchClient())
+    get_storage_client.set(None)  # Blob.from_string works without a client
+    get_grounding_tool.set('fake-tool')
@@ -0,0 +1,104 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of the JSON extraction from LLM output.
+# Compares util.docsnsnips.extract_json with the previous cleanup_json on a corpus of
+# malformed model outputs and on long strings with many inner quotes.
+#
+# Usage (from the DBHackbot directory):
+#   python -m benchmarks.json_extract
+
+import json
+import time
+from util.docsnsnips import extract_json, JsonExtractor
+
+CORPUS = 'benchmarks/data/malformed_json.jsonl'
+
+
+def legacy_cleanup_json(x: str):
+    """The cleanup_json we had before, kept here for comparison (quadratic on inner quotes)"""
+    def following_char(i, s):
+        i += 1
+        while i < len(s) and s[i].isspace():
+            i += 1
+        return s[i] if i < len(s) else ''
+    startBrace = x.find('{')
+    endBrace = x.rfind('}')
+    if startBrace == -1 or endBrace == -1 or startBrace > endBrace:
+        return None
+    the_json = x[startBrace:endBrace+1].replace('\n', ' ')
+    inquote = False
+    i = 0
+    while i < len(the_json):
+        if the_json[i] == '"' and (i == 0 or the_json[i-1] != '\\'):
+            if inquote:
+                if following_char(i, the_json).isalpha():
+                    the_json = the_json[0:i] + '\\' + the_json[i:]
+                    i += 2
+                    while i < len(the_json) and the_json[i] != '"':
+                        i += 1
+                    if i < len(the_json):
+                        the_json = the_json[0:i] + '\\' + the_json[i:]
+                        i += 2
+                else:
+                    inquote = False
+                    i += 1
+            else:
+                inquote = True
+                i += 1
+        else:
+            i += 1
+    return the_json
+
+def legacy_extract(x: str):
+    try:
+        return json.loads(legacy_cleanup_json(x))
+    except Exception:
+        return None
+
+def timed(function, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [function(text) for text in texts]
+    return (time.perf_counter() - start) / repeat / len(texts), results
+
+def streamed(text, chunk_size=8):
+    extractor = JsonExtractor()
+    for i in range(0, len(text), chunk_size):
+        if extractor.feed(text[i:i + chunk_size]) is not None:
+            return extractor.result, min(i + chunk_size, len(text))
+    return extractor.finish(), len(text)
+
+def run(repeat=200):
+    with open(CORPUS) as f:
+        corpus = [json.loads(line)['text'] for line in f if line.strip()]
+    results = {'corpus_size': len(corpus)}
+    for name, function in (('legacy', legacy_extract), ('extract_json', extract_json)):
+        seconds, parsed = timed(function, corpus, repeat)
+        results[name] = {'us_per_doc': seconds * 1e6, 'parsed': sum(p is not None for p in parsed)}
+    # Growth with the number of inner quotes: linear vs quadratic
+    results['scaling'] = []
+    for quotes in (100, 1000, 5000):
+        text = '{"reason": "' + ' '.join(f'word "q{i}" more' for i in range(quotes)) + '"}'
+        legacy, _ = timed(legacy_extract, [text], 3)
+        current, _ = timed(extract_json, [text], 3)
+        results['scaling'].append({'inner_quotes': quotes, 'legacy_ms': legacy * 1e3, 'extract_json_ms': current * 1e3})
+    # How early a streamed intent is decided
+    consumed = [streamed(text)[1] / len(text) for text in corpus if extract_json(text) is not None]
+    results['stream_fraction_read'] = sum(consumed) / len(consumed)
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,70 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cold start benchmark.
+# Every measurement runs in a fresh Python process, like a new Cloud Run container.
+# Reports the import time of our modules and the time until the first page (the password
+# page) is rendered, plus which Google libraries got loaded on the way.
+#
+# Usage (from the DBHackbot directory):
+#   python -m benchmarks.startup
+
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ['streamlit', 'util.auth', 'util.chat', 'util.llm', 'util.rag', 'vertexai']
+GOOGLE_MODULES = ('vertexai', 'google.cloud.aiplatform', 'google.cloud.discoveryengine', 'google.cloud.storage')
+
+IMPORT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+'''
+
+FIRST_PAGE_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file('main.py', default_timeout=120)
+app.run()
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed,
+                  'password_page': len(app.text_input) > 0,
+                  'google_modules_loaded': sorted(m for m in sys.modules if m.startswith(%r))}))
+''' % (GOOGLE_MODULES,)
+
+
+def run_python(script, **env):
+    environment = dict(os.environ, **env)
+    environment.setdefault('GOOGLE_CLOUD_PROJECT', 'benchmark')
+    environment.setdefault('PASSWORD', 'benchmark')
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, env=environment)
+    if result.returncode != 0:
+        return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def run():
+    results = {'import_seconds': {}}
+    for module in MODULES:
+        results['import_seconds'][module] = run_python(IMPORT_SCRIPT.format(module=module))
+    results['first_page'] = run_python(FIRST_PAGE_SCRIPT, WARM_UP='false')
+    results['first_page_with_warm_up'] = run_python(FIRST_PAGE_SCRIPT, WARM_UP='true')
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,141 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline micro-benchmarks. Gemini and Vertex AI Search are replaced by the fakes
+# in benchmarks/fakes.py, so no Google service (or credentials) is needed.
+# Results go to a JSON file. With --baseline, results are compared with an earlier
+# run and the exit code is 1 if anything got slower than the tolerance.
+#
+# Usage (from the DBHackbot directory):
+#   python -m benchmarks.suite [--output results.json] [--baseline old.json] [--tolerance 0.2]
+#                              [--model-latency 0.3] [--chunk-latency 0.02] [--words 150] [--search-latency 0.2]
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+# Settings are read on import: no answer or retrieval cache, no precomputed prefab answers, no intent log, no trained intent model
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'benchmark')
+os.environ['CACHE_TTL'] = '0'
+os.environ['RETRIEVAL_CACHE_TTL'] = '0'
+os.environ['PREFAB_REFRESH'] = '0'
+os.environ['INTENT_LOG'] = ''
+os.environ['INTENT_MODEL'] = os.devnull
+
+from benchmarks.fakes import FakeModel, FakeSearchClient, install
+from util import engine, prompts, rag
+from util.docsnsnips import cleanup_json
+from util.history import History
+from util.references import reference_markdown
+from util.stream import documents
+
+CORPUS = 'benchmarks/data/malformed_json.jsonl'
+
+
+def measure(function, repeat):
+    """Runs function repeat times, returns timing statistics in milliseconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {'mean_ms': statistics.fmean(times), 'p50_ms': times[len(times) // 2],
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))], 'runs': repeat}
+
+def measure_turn(query, repeat):
+    """handle_query end to end: time to first text and time to the complete answer"""
+    first, total = [], []
+    for _ in range(repeat):
+        history = engine.new_history()
+        start = time.perf_counter()
+        response = engine.handle_query(query, history)
+        got_first = None
+        for _ in response.pop('stream', []):
+            if got_first is None:
+                got_first = time.perf_counter()
+        end = time.perf_counter()
+        first.append(((got_first or end) - start) * 1000)
+        total.append((end - start) * 1000)
+    return {'first_text_ms': statistics.fmean(first), 'total_ms': statistics.fmean(total), 'runs': repeat}
+
+def run(args):
+    model = FakeModel(first_chunk_latency=args.model_latency, chunk_latency=args.chunk_latency, words=args.words)
+    install(model, FakeSearchClient(latency=args.search_latency))
+    results = {}
+    results['handle_query_other'] = measure_turn('How fast is an elephant?', args.turns)
+    results['handle_query_alphabet'] = measure_turn('What is the business model of alphabet?', args.turns)
+    results['get_intent_llm'] = measure(lambda: engine.get_intent('', 'Tell me more about the largest bets'), args.turns)
+
+    # Local work, no fake latency involved
+    with open(CORPUS) as f:
+        corpus = [json.loads(line)['text'] for line in f if line.strip()]
+    results['cleanup_json'] = measure(lambda: [cleanup_json(text) for text in corpus], args.repeat)
+    history = History(budget=4000)
+    for i in range(200):
+        history.append('user' if i % 2 == 0 else 'chatbot', FakeModel().output(f'turn {i}'))
+    results['make_history_200_turns'] = measure(lambda: engine.make_history(history), args.repeat)
+    results['make_history_intent_budget'] = measure(lambda: engine.make_history(history, 500), args.repeat)
+    rendered = engine.make_history(history)
+    results['prompt_prepare'] = measure(lambda: prompts.companion.prepare(rendered, 'How fast is an elephant?'), args.repeat)
+    summary = FakeSearchClient().search(None).summary.summary_text
+    results['list_parser'] = measure(lambda: rag.list_parser(summary), args.repeat)
+    rag.get_search_client.set(FakeSearchClient(latency=0))
+    # Until the answer is there, and until its references are there as well (the same with REFERENCES=full)
+    results['search_engine_summary_assembly'] = measure(lambda: rag.search_engine_summary('alphabet revenue'), args.repeat)
+    results['search_engine_summary_with_references'] = measure(lambda: documents(rag.search_engine_summary('alphabet revenue')), args.repeat)
+    docs = documents(rag.search_engine_summary('alphabet revenue'))
+    results['reference_rendering'] = measure(lambda: [reference_markdown(doc) for doc in docs], args.repeat)
+    return {'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                            'model_latency': args.model_latency, 'chunk_latency': args.chunk_latency,
+                            'words': args.words, 'search_latency': args.search_latency},
+            'results': results}
+
+def compare(current, baseline, tolerance):
+    """Lists the benchmarks that got slower than baseline * (1 + tolerance)"""
+    regressions = []
+    for name, values in current['results'].items():
+        old = baseline.get('results', {}).get(name, {})
+        for key, value in values.items():
+            if key.endswith('_ms') and old.get(key) and value > old[key] * (1 + tolerance):
+                regressions.append(f'{name}.{key}: {old[key]:.3f} -> {value:.3f} ms')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks with fake Gemini and Vertex AI Search')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=200, help='runs of the local benchmarks')
+    parser.add_argument('--turns', type=int, default=5, help='runs of the benchmarks with fake latency')
+    parser.add_argument('--model-latency', type=float, default=0.3)
+    parser.add_argument('--chunk-latency', type=float, default=0.02)
+    parser.add_argument('--words', type=int, default=150)
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    args = parser.parse_args()
+    current = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(json.dumps(current['results'], indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(current, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
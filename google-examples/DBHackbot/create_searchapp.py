@@ -13,13 +13,16 @@
 # limitations under the License.
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import discoveryengine_v1 as discoveryengine
 from google.cloud import aiplatform
 from google.api_core.client_options import ClientOptions
-import json
 from google.cloud import storage
 from google.api_core.exceptions import AlreadyExists, Conflict
 from util.settings import PROJECT, REGION, LOCATION, engine_ds_name
+from util.upload import upload_directory, md5_base64
+from util.reindex import manifest_entry, manifest_name, diff, write_metadata, load_manifest, save_manifest
+from util.pipeline import Stage, Pipeline
 
 
 DOCDIR = os.getenv("DOCDIR")
@@ -33,24 +36,20 @@ location = LOCATION
 aiplatform.init(project=project)
 client_options = ( ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com") if location != 'global' else None )
 
-# First, create datastore
+# The setup runs as a pipeline of stages (see util/pipeline.py):
+#
+#   datastore ----+-------------------------------> engine
+#                 +--> clean --+--> import --> manifest
+#   documents ----+------------+
+#
+# Independent stages run at the same time, long running operations are polled until done.
+# If the script is interrupted, run it again: it picks up where it stopped.
+
 ds_client = discoveryengine.DataStoreServiceClient(client_options=client_options)
-ds_parent = ds_client.collection_path(project=project, location=location, collection='default_collection')
-ds_path = ds_client.data_store_path(project=project, location=location, data_store=engine_ds_name)
-print(f"Creating datastore {ds_path}...")
-datastore = discoveryengine.DataStore(name=ds_path, display_name='Datastore for DB Hackathon',
-                                         industry_vertical=discoveryengine.IndustryVertical.GENERIC,
-                                         solution_types=[discoveryengine.SolutionType.SOLUTION_TYPE_SEARCH],
-                                         content_config=discoveryengine.DataStore.ContentConfig.CONTENT_REQUIRED)
-ds_request = discoveryengine.CreateDataStoreRequest(parent=ds_parent, data_store=datastore, data_store_id=engine_ds_name)
-try:
-    operation = ds_client.create_data_store(request=ds_request)
-    the_datastore = operation.result()
-    print(f"Datastore {ds_path} created successfully")
-except AlreadyExists:
-    print(f'Datastore {engine_ds_name} already exists - no action')
-
-# Now import documents into datastore
+document_client = discoveryengine.DocumentServiceClient(client_options=client_options)
+engine_client = discoveryengine.EngineServiceClient(client_options=client_options)
+document_parent = document_client.branch_path(project=project, location=location, data_store=engine_ds_name, branch='default_branch')
+
 our_bucket_name = 'dbhackathon_input_' + project
 json_bucket_name = our_bucket_name
 if DOCDIR.startswith('gs://'):
@@ -60,91 +59,155 @@ else:
     # We have a directory for our documents
     input_bucket_name = our_bucket_name
 metadata_name = 'metadata.jsonl'
-print()
-# Create our bucket if not exists
-print("Creating our bucket...")
 storage_client = storage.Client()
-bucket_client = storage.Client(project=project)
-try:
-    bucket_client.create_bucket(our_bucket_name, location=region)
-    print(f"Created bucket {our_bucket_name}")
-except Conflict:
-    print(f"Our bucket {our_bucket_name} already exists - no action")
-
-# Create Metadata for import
-metadata = []
-# {"id":"doc-3","structData":{"title":"test_doc_3"},"content":{"mimeType":"application/pdf","uri":"gs://test-bucket-12345678/test_doc_4.pdf"}}
-input_bucket = storage_client.bucket(input_bucket_name)
-if input_bucket_name == our_bucket_name: # if the input is a directory
-    enumerator = enumerate(os.listdir(DOCDIR))
-else:
-    enumerator = enumerate([n.name for n in input_bucket.list_blobs(fields='items(name)')])
-for i, f in enumerator:
-    fname = f
-    metadata.append({'id': str(i),
-                    'structData': {'file': fname},
-                    'content': {'mimeType': 'application/pdf', 'uri': 'gs://' + input_bucket_name + '/' + fname}})
-metajson = '\n'.join([json.dumps(m) for m in metadata])
 json_bucket = storage_client.bucket(json_bucket_name)
-print('Uploading metadata')
-blob = json_bucket.blob(metadata_name)
-blob.upload_from_string(metajson)
-
-# Upload files to input bucket if necessary
-if input_bucket_name == our_bucket_name: # if the input is a directory
-    for meta in metadata:
-        fname = meta['structData']['file']
-        print(f'Uploading {fname}')
-        blob = input_bucket.blob(fname)
-        blob.upload_from_filename(DOCDIR + '/' + fname)
-
-print()
-# Clean datastore of any previous contents
-print('Purging documents in data store', engine_ds_name)
-document_client = discoveryengine.DocumentServiceClient(client_options=client_options)
-document_parent = document_client.branch_path(project=project, location=location, data_store=engine_ds_name, branch='default_branch')
-purgeRequest = discoveryengine.PurgeDocumentsRequest(parent=document_parent, filter='*', force=True)
-try:
-    d_operation = document_client.purge_documents(request=purgeRequest)
-    d_response = d_operation.result()
-    print(f'Purged {d_response.purge_count} documents')
-except Exception as e:
-    print(f'ERROR trying to purge: {e}')
-
-print()
-# Now for the import
-print('Starting importing documents into data store.', engine_ds_name)
-jsonfile = 'gs://' + json_bucket_name + '/' + metadata_name
-import_error_bucket = os.environ.get('IMPORT_ERROR_BUCKET', 'gs://' + our_bucket_name + '/errors')
-import_request = discoveryengine.ImportDocumentsRequest(
-    parent=document_parent,
-    gcs_source=discoveryengine.GcsSource(input_uris=[jsonfile], data_schema='document'),
-    error_config=discoveryengine.ImportErrorConfig(gcs_prefix=import_error_bucket),
-    reconciliation_mode=discoveryengine.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL)
-try:
-    ds_operation = document_client.import_documents(request=import_request)
-except Exception as e:
-    print(f'ERROR trying to import: {e}')
-
-print()
-# Then create engine
-engine_client = discoveryengine.EngineServiceClient(client_options=client_options)
-engine_path = engine_client.engine_path(project=project, location=location, collection='default_collection', engine=engine_ds_name)
-print(f"Creating engine {engine_path}...")
-engine_client = discoveryengine.EngineServiceClient(client_options=client_options)
-engine_config = discoveryengine.Engine.SearchEngineConfig(search_tier=discoveryengine.SearchTier.SEARCH_TIER_ENTERPRISE, search_add_ons=[discoveryengine.SearchAddOn.SEARCH_ADD_ON_LLM])
-engine = discoveryengine.Engine(name=engine_path, display_name="Search Engine for DB Hackathon", data_store_ids=[engine_ds_name], solution_type=discoveryengine.SolutionType.SOLUTION_TYPE_SEARCH, search_engine_config=engine_config)
-engine_parent = engine_client.collection_path(project=project, location=location, collection='default_collection')
-engine_request = discoveryengine.CreateEngineRequest(parent=engine_parent, engine=engine, engine_id=engine_ds_name)
-try:
-    e_operation = engine_client.create_engine(request=engine_request)
-    the_engine = e_operation.result()
-    print(f"Engine {engine_path} created successfully")
-except AlreadyExists:
-    print(f'Engine {engine_ds_name} already exists - no action')
-
-print()
-print("Waiting for document import to complete. This can take a while...")
-print("May time out after 900s which does not mean a failed import")
-ds_response = ds_operation.result()
-print(f'Imported documents with {len(ds_response.error_samples)} errors')
+manifest_blob = json_bucket.blob(manifest_name(engine_ds_name))
+
+
+def create_datastore(results):
+    ds_parent = ds_client.collection_path(project=project, location=location, collection='default_collection')
+    ds_path = ds_client.data_store_path(project=project, location=location, data_store=engine_ds_name)
+    print(f"Creating datastore {ds_path}...")
+    datastore = discoveryengine.DataStore(name=ds_path, display_name='Datastore for DB Hackathon',
+                                             industry_vertical=discoveryengine.IndustryVertical.GENERIC,
+                                             solution_types=[discoveryengine.SolutionType.SOLUTION_TYPE_SEARCH],
+                                             content_config=discoveryengine.DataStore.ContentConfig.CONTENT_REQUIRED)
+    ds_request = discoveryengine.CreateDataStoreRequest(parent=ds_parent, data_store=datastore, data_store_id=engine_ds_name)
+    try:
+        return ds_client.create_data_store(request=ds_request)
+    except AlreadyExists:
+        print(f'Datastore {engine_ds_name} already exists - no action')
+        return 'exists'
+
+def prepare_documents(results):
+    # Create our bucket if not exists
+    print("Creating our bucket...")
+    bucket_client = storage.Client(project=project)
+    try:
+        bucket_client.create_bucket(our_bucket_name, location=region)
+        print(f"Created bucket {our_bucket_name}")
+    except Conflict:
+        print(f"Our bucket {our_bucket_name} already exists - no action")
+
+    # Find out what we have: {document id: {'file', 'uri', 'md5'}}
+    input_bucket = storage_client.bucket(input_bucket_name)
+    if input_bucket_name == our_bucket_name: # if the input is a directory
+        files = sorted(os.listdir(DOCDIR))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            hashes = executor.map(md5_base64, [os.path.join(DOCDIR, f) for f in files])
+        manifest = dict(manifest_entry(input_bucket_name, f, md5) for f, md5 in zip(files, hashes))
+    else:
+        manifest = dict(manifest_entry(input_bucket_name, b.name, b.md5_hash) for b in input_bucket.list_blobs(fields='items(name,md5Hash),nextPageToken'))
+
+    # Compare with what we imported last time
+    previous = load_manifest(manifest_blob)
+    if previous is None:
+        added, changed, deleted = list(manifest), [], []
+    else:
+        added, changed, deleted = diff(previous, manifest)
+    print(f'{len(added)} documents added, {len(changed)} changed, {len(deleted)} deleted since the last import')
+
+    # Upload files to input bucket if necessary
+    # Unchanged files are skipped, so a rerun continues an interrupted upload
+    if input_bucket_name == our_bucket_name: # if the input is a directory
+        stats = upload_directory(input_bucket, DOCDIR, [manifest[i]['file'] for i in added + changed],
+                                 workers=int(os.getenv('UPLOAD_WORKERS', '8')))
+        print(f"Uploaded {stats['uploaded']} files ({stats['bytes'] / 1024 / 1024:.1f} MB) in {stats['seconds']:.1f}s, "
+              f"{stats['skipped']} unchanged, {stats['failed']} failed")
+        if stats['failed']:
+            raise RuntimeError(f"{stats['failed']} files could not be uploaded")
+    return {'manifest': manifest, 'fresh': previous is None,
+            'import': added + changed, 'delete': [(i, previous[i]['file']) for i in deleted]}
+
+def clean_datastore(results):
+    documents = results['documents']
+    if documents['fresh']:
+        # No manifest yet, so we don't know the ids in the datastore: start from scratch once
+        print('Purging documents in data store', engine_ds_name)
+        purgeRequest = discoveryengine.PurgeDocumentsRequest(parent=document_parent, filter='*', force=True)
+        return document_client.purge_documents(request=purgeRequest)
+    if documents['delete']:
+        print(f"Deleting {len(documents['delete'])} documents from data store", engine_ds_name)
+        def delete_document(doc):
+            try:
+                document_client.delete_document(name=f'{document_parent}/documents/{doc[0]}')
+                return None
+            except Exception as e:
+                print(f'ERROR trying to delete {doc[1]}: {e}')
+                return doc
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            failed = [doc for doc in executor.map(delete_document, documents['delete']) if doc]
+        # Documents that could not be deleted stay in the manifest, the next run tries again
+        return {'delete_failed': failed}
+    return None
+
+def purged(d_response):
+    if d_response is not None:
+        print(f'Purged {d_response.purge_count} documents')
+
+def import_documents(results):
+    documents = results['documents']
+    if not documents['import']:
+        print('Nothing to import')
+        return None
+    # Import of new and changed documents
+    print(f"Starting importing {len(documents['import'])} documents into data store.", engine_ds_name)
+    print('Uploading metadata')
+    write_metadata(json_bucket.blob(metadata_name), documents['manifest'], documents['import'])
+    jsonfile = 'gs://' + json_bucket_name + '/' + metadata_name
+    import_error_bucket = os.environ.get('IMPORT_ERROR_BUCKET', 'gs://' + our_bucket_name + '/errors')
+    import_request = discoveryengine.ImportDocumentsRequest(
+        parent=document_parent,
+        gcs_source=discoveryengine.GcsSource(input_uris=[jsonfile], data_schema='document'),
+        error_config=discoveryengine.ImportErrorConfig(gcs_prefix=import_error_bucket),
+        reconciliation_mode=discoveryengine.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL)
+    return document_client.import_documents(request=import_request)
+
+def imported(ds_response):
+    if ds_response is not None:
+        print(f'Imported documents with {len(ds_response.error_samples)} errors')
+        return {'errors': len(ds_response.error_samples)}
+    return None
+
+def store_manifest(results):
+    # Remember what the datastore contains now for the next run
+    documents = results['documents']
+    manifest = dict(documents['manifest'])
+    if (results.get('import') or {}).get('errors'):
+        # The error samples don't tell reliably which documents failed:
+        # none of this run's documents count as imported, the next run imports them again
+        print(f"Import had errors, {len(documents['import'])} documents will be imported again next time")
+        for doc_id in documents['import']:
+            manifest.pop(doc_id, None)
+    for doc_id, file in (results.get('clean') or {}).get('delete_failed', []):
+        manifest[doc_id] = manifest_entry(input_bucket_name, file, '')[1]
+    save_manifest(manifest_blob, manifest)
+
+def create_engine(results):
+    engine_path = engine_client.engine_path(project=project, location=location, collection='default_collection', engine=engine_ds_name)
+    print(f"Creating engine {engine_path}...")
+    engine_config = discoveryengine.Engine.SearchEngineConfig(search_tier=discoveryengine.SearchTier.SEARCH_TIER_ENTERPRISE, search_add_ons=[discoveryengine.SearchAddOn.SEARCH_ADD_ON_LLM])
+    engine = discoveryengine.Engine(name=engine_path, display_name="Search Engine for DB Hackathon", data_store_ids=[engine_ds_name], solution_type=discoveryengine.SolutionType.SOLUTION_TYPE_SEARCH, search_engine_config=engine_config)
+    engine_parent = engine_client.collection_path(project=project, location=location, collection='default_collection')
+    engine_request = discoveryengine.CreateEngineRequest(parent=engine_parent, engine=engine, engine_id=engine_ds_name)
+    try:
+        return engine_client.create_engine(request=engine_request)
+    except AlreadyExists:
+        print(f'Engine {engine_ds_name} already exists - no action')
+        return 'exists'
+
+
+pipeline = Pipeline([
+        Stage('datastore', create_datastore, on_done=lambda r: 'created'),
+        Stage('documents', prepare_documents),
+        Stage('clean', clean_datastore, depends=('datastore', 'documents'), on_done=purged,
+              response_type=discoveryengine.PurgeDocumentsResponse),
+        Stage('import', import_documents, depends=('clean',), on_done=imported,
+              response_type=discoveryengine.ImportDocumentsResponse),
+        Stage('manifest', store_manifest, depends=('clean', 'import')),
+        Stage('engine', create_engine, depends=('datastore',), on_done=lambda r: 'created'),
+    ],
+    get_operation=lambda name: ds_client.get_operation({'name': name}))
+if not pipeline.run():
+    print('Setup did not complete. Run it again to continue where it stopped.')
+    exit(1)
@@ -13,17 +13,13 @@
 # limitations under the License.
 
 import streamlit as st
-import time
-import json
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from util.chat import prepare_chat, display_chat, display_chat_message, icons
-from util.references import prepare_references, display_references
-from util.docsnsnips import cleanup_json
-from util.llm import modelg
-from util.rag import search_engine_grounding
+import threading
+from util.chat import prepare_chat, display_chat, display_chat_message, icons, session_id
+from util.references import prepare_references, display_references, compact_reference
 from util.auth import check_password
-from vertexai.preview.generative_models import GenerationConfig, Part
+from util.images import FILE_TYPES, thumbnail, ImageError
+from util import metrics
+from util.settings import WARM_UP, ENGINE_URL, TRACING, METRICS_PORT, CHAT_WINDOW, PREFAB_QUESTIONS, PREFAB_REFRESH
 
 # This is a streamlit application. Streamlit has a particular model of how operate:
 # The entire code is run through each time an action occurs on the page.
@@ -56,10 +52,41 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+# Create the Google clients in the background, once per process,
+# while the first visitor is still looking at the password page.
+# Then the answers to the prefab questions are computed, and kept up to date.
+@st.cache_resource
+def start_warm_up():
+    def warm_up():
+        from util.rag import warm_up
+        warm_up()
+        if PREFAB_REFRESH > 0:
+            from util.engine import get_prefab_answers
+            get_prefab_answers().start()
+    threading.Thread(target=warm_up, daemon=True).start()
+
+if WARM_UP and not ENGINE_URL:
+    start_warm_up()
+
+# Prometheus exporter for the metrics of this process, see util/metrics.py
+@st.cache_resource
+def start_metrics():
+    return metrics.serve(METRICS_PORT)
+
+if TRACING and METRICS_PORT:
+    start_metrics()
+
 # First check basic auth
 if not check_password():
     st.stop()  # Do not continue if check_password is not True.
 
+# The chat engine (and with it the Google libraries) is only loaded once the user is in.
+# With ENGINE_URL set, it runs as a separate service and we are just a thin client.
+if ENGINE_URL:
+    from util.client import RemoteEngine
+else:
+    from util import engine
+
 # Initialize chat history
 prepare_chat()
 
@@ -69,14 +96,9 @@ prepare_references()
 # Display references on app rerun
 references = display_references()
 
-# Prefab questions
-question_keys = ["q1", "q2", "q3"]
-questions = ["How fast is an elephant?", "Tell me a Chuck Norris joke", "What is the business model of alphabet?"]
-def prefab_question():
-    for i, key in enumerate(question_keys):
-        if key in st.session_state and st.session_state[key] is True:
-            st.session_state.ask_this = questions[i]
-            break
+# Prefab questions, configured in PREFAB_QUESTIONS
+def prefab_question(question):
+    st.session_state.ask_this = question
 
 # Uncomment the next line if you want to disable prefabs
 # st.session_state.been_here_before = True
@@ -84,10 +106,10 @@ def prefab_question():
 # Display prefab questions
 # only until first question has been asked
 if 'been_here_before' not in st.session_state:
-    col1, col2, col3 = st.columns(3)
-    col1.button(f"**Option 1**\n\n\n\n*{questions[0]}*", key=question_keys[0], on_click=prefab_question)
-    col2.button(f"**Option 2**\n\n\n\n*{questions[1]}*", key=question_keys[1], on_click=prefab_question)
-    col3.button(f"**Option 3**\n\n\n\n*{questions[2]}*", key=question_keys[2], on_click=prefab_question)
+    # Three buttons per row
+    for row in range(0, len(PREFAB_QUESTIONS), 3):
+        for column, (i, question) in zip(st.columns(3), enumerate(PREFAB_QUESTIONS[row:row + 3], start=row + 1)):
+            column.button(f"**Option {i}**\n\n\n\n*{question}*", key=f"q{i}", on_click=prefab_question, args=(question,))
     # Custom button styling
     st.markdown(
         """
@@ -113,120 +135,92 @@ chat_space = st.container()
 with chat_space:
     display_chat()
 
-def ask_gemini(history, query, image=None, temperature=1):
-    current_time = datetime.now(tz=ZoneInfo("Europe/Berlin"))
-    llm_prompt1 = f"Today is {current_time.strftime('%A, %B %-d %Y')}. The current time is {current_time.strftime('%-H:%M')}.\n"\
-                "You are a cheerful chat companion. Your input are a chat history between a chatbot and a user. "\
-                "You are given the latest question from the user which you have to answer in a safe and joyful way.\n"\
-                "Provide answers that are suitable for any audience. Try to keep your responses to a few lines of text. For long answers, only mention the highlights.\n\n"\
-                f"Chat history:\n{history}\n"
-    llm_prompt2 = f"user: {query}\n"\
-                "chatbot: "
-    contents = [Part.from_text(llm_prompt1)]
-    if image:
-        contents.append(Part.from_image(image))
-    contents.append(Part.from_text(llm_prompt2))
-    generation_config = GenerationConfig(candidate_count=1, max_output_tokens=2048, temperature=temperature)
-    response = {'response': ''}
-    try:
-        gen_response = modelg.generate_content(contents, stream=False, generation_config=generation_config)
-    except Exception as e:
-        response['response'] = f'Oh no! A problem occurred:\n{str(e)}\n'
-    response['response'] += gen_response.text
-    return response
-
-def make_history():
-    history = ''
-    for message in st.session_state.messages[:-1]:
-        history += f'{message["role"]}: {message["text"]}\n'
-    return history    
-
-def get_intent(history, query):
-    llm_prompt = f"""Given a conversation history between a user and a chatbot, your job is to identify the intent of the latest query by the user.
-The intent can either be related to the company alphabet, including its subsidiaries (also called bets), or the intent can be other.
-Provide your output as JSON. Do not generate any other content. This is what your output should look like:
-{{
-   "intent": "alphabet" if the question is related to alphabet or its subsidiaries; "other" if it is any other topic
-}}
-
-Conversation history:
-{history}
-
-Latest query:
-{query}
-
-Your result:
-""" 
-    contents = [Part.from_text(llm_prompt)]
-    generation_config = GenerationConfig(candidate_count=1, max_output_tokens=400)
+@st.cache_resource
+def get_remote_engine():
+    return RemoteEngine(ENGINE_URL)
+
+def get_history():
+    # The history of this session, kept up to date turn by turn by the engine
+    if 'history' not in st.session_state:
+        st.session_state.history = engine.new_history()
+        # A transcript picked up again after a restart: the engine gets its newest messages
+        messages = st.session_state.messages
+        for message in messages.page(len(messages) - CHAT_WINDOW):
+            st.session_state.history.append(message.role, message.text)
+    return st.session_state.history
+
+def handle_query(query, image=None):
+    # The actual chat logic resides in util/engine.py
+    if ENGINE_URL:
+        return get_remote_engine().handle_query(query, session_id(), image)
+    return engine.handle_query(query, get_history(), session=session_id(), image=image)
+
+def ask_question(prompt, image=None):
+    # The turn is traced until the answer and its references are on the screen
+    turn = metrics.start_turn()
     try:
-        gen_response = modelg.generate_content(contents, stream=False, generation_config=generation_config)
-    except Exception as e:
-        print(f'Exception during detect intent: {e}')
-        return {'intent': 'other'}
-    intent = cleanup_json(str(gen_response.text))
+        show_answer(prompt, image)
+    finally:
+        metrics.end_turn(turn)
+
+def image_preview(image):
+    # The transcript only keeps a small copy of the image, the engine gets the upload
     try:
-        intent = json.loads(intent)
-    except Exception as e:
-        print(f"ERROR - llm response parsing failed for '{gen_response.text}': {e}")
-        intent = {'intent': 'other'}
-    return intent
-
-# -----------------------------------------------
-#  This is where the actual chat logic resides
-# -----------------------------------------------
-def handle_query(query):
-    # We can do lots of stuff here: Find out user intent, generate SQL, generate pictures,
-    # search for information...
-    history = make_history()
-    intent = get_intent(history, query)
-    print(intent)
-    if intent['intent'] == 'alphabet':
-        #response = {'response': "It's RAG time!"}
-        response = search_engine_grounding(history, query)
-    else:
-        # We can also just ask Gemini
-        response = ask_gemini(history, query)
-    return response
-
-def ask_question(prompt):
+        return thumbnail(image) if image else None
+    except ImageError:
+        return None
+
+def show_answer(prompt, image=None):
     global references
     # Add user message to chat history
-    newmsg = {"role": "user", "text": prompt}
-    st.session_state.messages.append(newmsg)
+    newmsg = st.session_state.messages.append("user", prompt, image_preview(image))
     # Display user message in chat message container
     with chat_space:
         display_chat_message(newmsg)
     # Ask the AI to handle our request
-    response = handle_query(prompt)
+    with metrics.span('engine'):
+        response = handle_query(prompt, image)
     # Display assistant response in chat message container
     with chat_space:
         with st.chat_message("chatbot", avatar=icons["chatbot"]):
-            full_response = ""
-            # Simulate stream of response with milliseconds delay
+            response_placeholder = st.empty()
+            if 'stream' in response:
+                # Render chunks as they arrive from the model
+                full_response = ''
+                stream = response.pop('stream')
+                while True:
+                    # Waiting for the next chunk and rendering it are traced separately
+                    with metrics.span('wait'):
+                        chunk = next(stream, None)
+                    if chunk is None:
+                        break
+                    full_response += chunk
+                    # Add a blinking cursor while we are still receiving
+                    with metrics.span('render'):
+                        response_placeholder.markdown(full_response + "▌")
             assistant_response = response.get('response')
             if assistant_response and assistant_response != '':
-                response_placeholder = st.empty()
-                for chunk in assistant_response.split():
-                    full_response += chunk + " "
-                    time.sleep(0.02)
-                    # Add a blinking cursor to simulate typing
-                    response_placeholder.markdown(full_response + "▌")
-                response_placeholder.markdown(assistant_response)
+                with metrics.span('render'):
+                    response_placeholder.markdown(assistant_response)
     # Add assistant response to chat history
-    newmsg = {"role": "chatbot", "text": assistant_response }
-    st.session_state.messages.append(newmsg)
+    st.session_state.messages.append("chatbot", assistant_response)
     # Handle references if there are any
-    st.session_state.references = []
-    ref_flag = False
-    for doc in response.get('documents',[]):
-        newref = dict(doc)
-        st.session_state.references.append(newref)
-        ref_flag = True
-    # references = display_references(references)
-    # instead we rerun because of a bug in streamlit: empties are not cleared properly leading to clutter in sidebar
-    if ref_flag:
-        st.rerun()
+    if response.get('references'):
+        # The answer is on the screen already. The documents are built in the background (REFERENCES=lazy),
+        # each one goes into the sidebar as soon as it is there.
+        st.session_state.references = []
+        for future in response['references']:
+            if future.exception() is None:
+                st.session_state.references.append(compact_reference(future.result()))
+                with metrics.span('render'):
+                    display_references(references)
+        if not st.session_state.references:
+            display_references(references)
+    elif response.get('documents') or st.session_state.references:
+        st.session_state.references = [compact_reference(doc) for doc in response.get('documents', [])]
+        # Only the sidebar placeholder is updated, no rerun of the whole script
+        with metrics.span('render'):
+            display_references(references)
 
 # Do we have a prefab question?
 if st.session_state.get("ask_this"):
@@ -234,6 +228,8 @@ if st.session_state.get("ask_this"):
     st.session_state.ask_this = None
     ask_question(hlp)
 
-# Accept user input
-if prompt := st.chat_input("What would you like to know?"):
-    ask_question(prompt)
\ No newline at end of file
+# Accept user input, optionally with an image
+if prompt := st.chat_input("What would you like to know?", accept_file=True, file_type=FILE_TYPES):
+    image = prompt.files[0].getvalue() if prompt.files else None
+    if prompt.text or image:
+        ask_question(prompt.text or "What is in this picture?", image)
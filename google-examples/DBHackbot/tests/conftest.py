@@ -0,0 +1,61 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline tests. Gemini and Vertex AI Search are replaced by the fakes in benchmarks/fakes.py,
+# every test gets its own scheduler.
+#
+# Usage (from the DBHackbot directory):
+#   python -m pytest -q tests
+
+import os
+import sys
+import time
+
+# Settings are read on import: no answer or retrieval cache, no precomputed prefab answers, no intent log, no trained intent model
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'test')
+os.environ['CACHE_TTL'] = '0'
+os.environ['RETRIEVAL_CACHE_TTL'] = '0'
+os.environ['PREFAB_REFRESH'] = '0'
+os.environ['INTENT_LOG'] = ''
+os.environ['INTENT_MODEL'] = os.devnull
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from benchmarks.fakes import install
+from util import calls
+from util.scheduler import Scheduler, get_scheduler
+
+install()
+
+
+@pytest.fixture
+def scheduler():
+    """The scheduler of the calls in the test: two slots, no rate limit, no latency history for hedging"""
+    scheduler = Scheduler(max_concurrent=2, max_queued=8, turns_per_minute=0)
+    get_scheduler.set(scheduler)
+    calls._latencies.clear()
+    return scheduler
+
+
+@pytest.fixture
+def until():
+    """until(condition, timeout) waits for a condition set by another thread, returns whether it came true"""
+    def until(condition, timeout=3):
+        end = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > end:
+                return False
+            time.sleep(0.01)
+        return True
+    return until
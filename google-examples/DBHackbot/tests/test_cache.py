@@ -0,0 +1,158 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from util import cache as cache_module
+from util.cache import AnswerCache, RetrievalCache, normalize
+
+
+class Clock:
+    """Stands in for the time module of util.cache, moved on by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, 'time', clock)
+    return clock
+
+
+def answer(text='The answer', documents=()):
+    return {'response': text, 'documents': [{'name': name} for name in documents]}
+
+
+def test_same_question_on_a_fresh_session():
+    cache = AnswerCache()
+    cache.put(cache.key('What is Waymo?', 'alphabet', ''), answer(documents=['report.pdf']))
+    assert cache.get(cache.key('  what is   waymo ', 'alphabet', '')) == answer(documents=['report.pdf'])
+    assert cache.get(cache.key('What is Waymo?', 'other', '')) is None
+    assert normalize('What  is Waymo?!') == 'what is waymo'
+
+
+def test_turns_with_history_are_not_cached():
+    cache = AnswerCache()
+    assert cache.key('And its revenue?', 'alphabet', 'user: What is Waymo?\n') is None
+    assert cache.get(None) is None
+
+
+def test_copies_are_handed_out():
+    cache = AnswerCache()
+    key = cache.key('q', 'other', '')
+    cache.put(key, answer(documents=['a.pdf']))
+    cache.get(key)['documents'][0]['name'] = 'changed'
+    assert cache.get(key)['documents'][0]['name'] == 'a.pdf'
+
+
+def test_time_to_live(clock):
+    cache = AnswerCache(ttl=60)
+    key = cache.key('q', 'other', '')
+    cache.put(key, answer())
+    clock.now += 59
+    assert cache.get(key) is not None
+    assert cache.contains_query('q', '')
+    clock.now += 2
+    assert not cache.contains_query('q', '')
+    assert cache.get(key) is None
+    assert cache.stats()['size'] == 0
+
+
+def test_least_recently_used_goes_first():
+    cache = AnswerCache(max_size=2)
+    keys = [cache.key(f'q{i}', 'other', '') for i in range(3)]
+    cache.put(keys[0], answer('0'))
+    cache.put(keys[1], answer('1'))
+    cache.get(keys[0])
+    cache.put(keys[2], answer('2'))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0])['response'] == '0'
+    assert cache.get(keys[2])['response'] == '2'
+
+
+@pytest.mark.parametrize('response', [
+    {'response': ''},
+    {'response': 'Lots of people are chatting with me right now', 'error': True},
+    {'response': '\nOh no! A problem occurred:\n503\n'},
+], ids=['empty', 'error', 'failed stream'])
+def test_failed_answers_are_not_cached(response):
+    cache = AnswerCache()
+    key = cache.key('q', 'other', '')
+    cache.put(key, response)
+    assert cache.get(key) is None
+
+
+def test_streamed_answer_is_cached_when_done():
+    cache = AnswerCache()
+    key = cache.key('q', 'other', '')
+    response = {'response': '', 'documents': []}
+    def stream():
+        for piece in ('The ', 'answer'):
+            response['response'] += piece
+            yield piece
+    response['stream'] = stream()
+    response = cache.put_when_done(key, response)
+    assert cache.get(key) is None
+    assert ''.join(response['stream']) == 'The answer'
+    assert cache.get(key)['response'] == 'The answer'
+
+
+def test_search_result_depends_on_the_request():
+    cache = RetrievalCache()
+    cache.put(cache.key('What is Waymo?', 'summary', 10), answer())
+    assert cache.get(cache.key('what is waymo', 'summary', 10)) == answer()
+    assert cache.get(cache.key('What is Waymo?', 'summary', 5)) is None
+
+
+def test_search_results_from_before_the_import_are_ignored():
+    cache = RetrievalCache()
+    key = cache.key('q')
+    cache.put(key, answer(), generation='2024-05-01T10:00:00')
+    assert cache.get(key, '2024-05-01T10:00:00') == answer()
+    assert cache.get(key, '2024-06-01T10:00:00') is None
+
+
+def test_search_results_expire(clock):
+    cache = RetrievalCache(ttl=60)
+    key = cache.key('q')
+    cache.put(key, answer())
+    clock.now += 61
+    assert cache.get(key) is None
+
+
+def test_search_results_least_recently_used_goes_first():
+    cache = RetrievalCache(max_size=2)
+    keys = [cache.key(f'q{i}') for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.put(key, answer(str(i)))
+    cache.get(keys[0])
+    cache.put(keys[2], answer('2'))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0])['response'] == '0'
+
+
+def test_search_results_shared_through_the_file(tmp_path):
+    path = str(tmp_path / 'retrieval.sqlite')
+    key = RetrievalCache.key('q')
+    RetrievalCache(path=path).put(key, answer(documents=['a.pdf']), generation='g1')
+    other = RetrievalCache(path=path)
+    assert other.get(key, 'g1') == answer(documents=['a.pdf'])
+    assert other.get(key, 'g2') is None
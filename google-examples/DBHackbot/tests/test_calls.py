@@ -0,0 +1,164 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import threading
+import time
+import pytest
+from google.api_core import exceptions
+from benchmarks.fakes import FakeModel
+from util import calls, metrics
+from util.calls import call, call_stream, with_deadline
+from util.scheduler import for_session, BACKGROUND
+
+
+class SlowFirst(FakeModel):
+    """The first request is stuck for a while, the ones after it answer right away"""
+
+    def __init__(self, stuck=0.5, **kwargs):
+        super().__init__(first_chunk_latency=0.01, chunk_latency=0, words=40, **kwargs)
+        self.stuck = stuck
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        self.first_chunk_latency = self.stuck if self.calls == 0 else 0.01
+        return super().generate_content(contents, stream=stream, **kwargs)
+
+
+class FailsMidway(FakeModel):
+    """Streams that break after the first chunk"""
+
+    def stream(self, text, prompt_tokens, tools):
+        chunks = super().stream(text, prompt_tokens, tools)
+        yield next(chunks)
+        raise ConnectionError('stream broken')
+
+
+def generation(model):
+    return call_stream('generation', model.generate_content, 'question', stream=True)
+
+
+def test_stream_releases_slot_when_done(scheduler, until):
+    assert list(generation(FakeModel(first_chunk_latency=0.01, chunk_latency=0, words=40)))
+    assert until(lambda: scheduler.running == 0)
+
+
+def test_stream_releases_slot_when_closed(scheduler, until):
+    stream = generation(FakeModel(first_chunk_latency=0.01, chunk_latency=0, words=40))
+    next(stream)
+    assert scheduler.running == 1
+    stream.close()
+    assert until(lambda: scheduler.running == 0)
+
+
+def test_stream_releases_slot_when_dropped(scheduler, until):
+    stream = generation(FakeModel(first_chunk_latency=0.01, chunk_latency=0, words=40))
+    next(stream)
+    del stream
+    gc.collect()
+    assert until(lambda: scheduler.running == 0)
+
+
+def test_stream_releases_slot_when_broken(scheduler, until):
+    stream = generation(FailsMidway(first_chunk_latency=0.01, chunk_latency=0, words=40))
+    with pytest.raises(ConnectionError):
+        list(stream)
+    assert until(lambda: scheduler.running == 0)
+
+
+def test_lost_hedge_releases_slot(scheduler, until):
+    for _ in range(calls.HEDGE_SAMPLES):
+        calls._record('generation', 0.01)
+    model = SlowFirst()
+    with with_deadline(5):
+        assert list(generation(model))
+    assert model.calls == 2
+    # The stuck request answers later, its stream is closed and the slot is free again
+    assert until(lambda: scheduler.running == 0)
+
+
+def test_queue_timeout_removes_waiter(scheduler):
+    held = [scheduler.acquire(), scheduler.acquire()]
+    with with_deadline(0.1), pytest.raises(TimeoutError):
+        call('generation', lambda: 'never called')
+    assert scheduler.waiting == 0
+    for release in held:
+        release()
+    assert scheduler.running == 0
+
+
+def test_retryable_error_is_retried(scheduler):
+    attempts = []
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise exceptions.ServiceUnavailable('overloaded')
+        return 'answer'
+    with with_deadline(5):
+        assert call('retrieval', flaky) == 'answer'
+    assert len(attempts) == 2
+
+
+def test_other_errors_are_not_retried(scheduler):
+    attempts = []
+    def broken():
+        attempts.append(1)
+        raise ValueError('bad request')
+    with with_deadline(5), pytest.raises(ValueError):
+        call('retrieval', broken)
+    assert len(attempts) == 1
+
+
+def test_retries_stop_at_the_deadline(scheduler):
+    def stuck():
+        raise exceptions.ServiceUnavailable('overloaded')
+    start = time.monotonic()
+    with with_deadline(0.3), pytest.raises((exceptions.ServiceUnavailable, TimeoutError)):
+        call('retrieval', stuck)
+    assert time.monotonic() - start < 1
+
+
+def test_hedge_wins(scheduler, until):
+    for _ in range(calls.HEDGE_SAMPLES):
+        calls._record('generation', 0.01)
+    model = SlowFirst(stuck=1)
+    start = time.monotonic()
+    with with_deadline(5):
+        assert call('generation', model.generate_content, 'question').text
+    assert time.monotonic() - start < 0.5
+    assert model.calls == 2
+    assert until(lambda: scheduler.running == 0)
+
+
+def test_no_hedge_without_latency_history(scheduler):
+    model = SlowFirst(stuck=0.2)
+    with with_deadline(5):
+        call('generation', model.generate_content, 'question')
+    assert model.calls == 1
+
+
+@pytest.mark.parametrize('stream', [False, True], ids=['call', 'stream'])
+def test_background_priority_of_the_context(scheduler, until, stream):
+    held = [scheduler.acquire(), scheduler.acquire()]
+    model = FakeModel(first_chunk_latency=0.01, chunk_latency=0, words=40)
+    with for_session('prefab', BACKGROUND):
+        request = generation(model) if stream else None
+        # Threads of a turn run in a copy of its context (metrics.bind), the stream is iterated outside of it
+        run = (lambda: list(request)) if stream else metrics.bind(lambda: call('generation', model.generate_content, 'question'))
+        thread = threading.Thread(target=run)
+        thread.start()
+    assert until(lambda: scheduler.stats()['waiting_background'] == 1)
+    for release in held:
+        release()
+    thread.join(timeout=3)
+    assert model.calls == 1
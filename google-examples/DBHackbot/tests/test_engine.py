@@ -0,0 +1,73 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from google.api_core import exceptions
+from benchmarks.fakes import FakeModel
+from util import calls, engine
+from util.calls import with_deadline
+from util.llm import get_model
+from util.settings import DEGRADE_BELOW
+
+
+class NoGrounding(FakeModel):
+    """Gemini answers, but every grounded request fails: right away, or when its stream starts"""
+
+    def __init__(self, lazy=False):
+        super().__init__(first_chunk_latency=0.01, chunk_latency=0, words=40)
+        self.lazy = lazy
+        self.grounded = 0
+
+    def generate_content(self, contents, stream=False, tools=None, **kwargs):
+        if tools:
+            self.grounded += 1
+            if not (self.lazy and stream):
+                raise exceptions.ServiceUnavailable('search is down')
+        return super().generate_content(contents, stream=stream, tools=tools, **kwargs)
+
+    def stream(self, text, prompt_tokens, tools):
+        if tools:
+            raise exceptions.ServiceUnavailable('search is down')
+        yield from super().stream(text, prompt_tokens, tools)
+
+
+@pytest.fixture
+def model(request, scheduler, monkeypatch):
+    monkeypatch.setattr(calls, 'CALL_RETRIES', 0)
+    model = NoGrounding(lazy=request.param)
+    get_model.set(model)
+    yield model
+    get_model.set(FakeModel())
+
+
+def answer(response):
+    return ''.join(response['stream']) if 'stream' in response else response['response']
+
+
+@pytest.mark.parametrize('model', [False, True], ids=['call', 'stream'], indirect=True)
+def test_failed_retrieval_falls_back_to_gemini(model):
+    with with_deadline(10 + DEGRADE_BELOW):
+        response = engine.search_or_ask('', 'What was the revenue of Alphabet in 2023?')
+        text = answer(response)
+    assert model.grounded == 1
+    assert text and not response.get('error')
+
+
+@pytest.mark.parametrize('model', [False], indirect=True)
+def test_no_retrieval_close_to_the_deadline(model):
+    with with_deadline(DEGRADE_BELOW / 2):
+        response = engine.search_or_ask('', 'What was the revenue of Alphabet in 2023?')
+        text = answer(response)
+    assert model.grounded == 0
+    assert text and not response.get('error')
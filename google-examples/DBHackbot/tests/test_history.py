@@ -0,0 +1,88 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from util.history import History, estimate_tokens
+
+TURN = 'x' * 76     # 'user: ' + TURN + '\n' is 21 tokens
+
+
+def run_now(function):
+    function()
+
+
+def test_newest_turns_that_fit():
+    history = History(budget=1000)
+    for i in range(10):
+        history.append('user', f'{i}{TURN}')
+    rendered = history.render(budget=50)
+    assert estimate_tokens(rendered) <= 50 + 2
+    assert rendered.splitlines() == [f'user: {i}{TURN}' for i in (8, 9)]
+    assert history.render().count('\n') == 10
+
+
+def test_empty_history():
+    assert History().render() == ''
+
+
+def test_old_turns_are_summarized():
+    calls = []
+    def summarize(summary, text):
+        calls.append((summary, text))
+        return f'summary {len(calls)}'
+    history = History(budget=100, summarize=summarize, submit=run_now)
+    for i in range(5):
+        history.append('user', f'{i}{TURN}')
+    # Over the budget: the oldest turns are folded into the summary, half the budget stays verbatim
+    assert len(calls) == 1 and calls[0][0] == ''
+    assert calls[0][1].startswith(f'user: 0{TURN}')
+    assert history.summary == 'summary 1'
+    assert history.summarized + len(history.turns) == 5
+    assert sum(tokens for _, tokens in history.turns) <= 50
+    rendered = history.render()
+    assert rendered.startswith('Summary of the earlier conversation: summary 1\n')
+    assert rendered.endswith(f'user: 4{TURN}\n')
+
+
+def test_summary_is_incremental():
+    calls = []
+    def summarize(summary, text):
+        calls.append((summary, text))
+        return f'summary {len(calls)}'
+    history = History(budget=100, summarize=summarize, submit=run_now)
+    for i in range(10):
+        history.append('user', f'{i}{TURN}')
+    # Every summary starts from the previous one and only gets the turns it doesn't cover yet
+    assert len(calls) > 1
+    for i, (summary, text) in enumerate(calls[1:], start=1):
+        assert summary == f'summary {i}'
+        assert f'user: 0{TURN}' not in text
+    assert history.summarized + len(history.turns) == 10
+
+
+def test_failed_summary_keeps_the_turns():
+    def summarize(summary, text):
+        raise RuntimeError('quota')
+    history = History(budget=100, summarize=summarize, submit=run_now)
+    for i in range(5):
+        history.append('user', f'{i}{TURN}')
+    assert history.summary == '' and len(history.turns) == 5
+    assert not history.summarizing
+    assert history.render().endswith(f'user: 4{TURN}\n')
+
+
+def test_summary_that_does_not_fit_is_left_out():
+    history = History(budget=100, summarize=lambda summary, text: 'y' * 1000, submit=run_now)
+    for i in range(5):
+        history.append('user', f'{i}{TURN}')
+    assert not history.render(budget=40).startswith('Summary')
@@ -0,0 +1,77 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import pytest
+from util.docsnsnips import JsonExtractor, extract_json, cleanup_json
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'data', 'malformed_json.jsonl')
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"intent": "other"}', {'intent': 'other'}),
+    ('```json\n{\n   "intent": "alphabet"\n}\n```', {'intent': 'alphabet'}),
+    ('Here is the result:\n```json\n{"intent": "alphabet"}\n```\nHope this helps!', {'intent': 'alphabet'}),
+    ('{"intent": "other"} and {"intent": "alphabet"}', {'intent': 'other'}),
+    ('{\n  "intent": "alphabet",\n}', {'intent': 'alphabet'}),
+    ('{"items": [1, 2, ], "x": {"y": 1,},}', {'items': [1, 2], 'x': {'y': 1}}),
+    ('{"reason": "asks about "Waymo", a bet", "intent": "alphabet"}', {'reason': 'asks about "Waymo", a bet', 'intent': 'alphabet'}),
+    ('{"reason": "line one\nline two"}', {'reason': 'line one\nline two'}),
+    ('{"path": "a\\\\b", "quote": "say \\"hi\\""}', {'path': 'a\\b', 'quote': 'say "hi"'}),
+], ids=['plain', 'fence', 'chatter', 'second object', 'trailing comma', 'nested trailing commas',
+        'unescaped quotes', 'raw newline', 'escapes'])
+def test_repairs(text, expected):
+    assert extract_json(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"intent": "other", "topics": ["a", "b"', {'intent': 'other', 'topics': ['a', 'b']}),
+    ('{"intent": "alphabet", "reason": "cut o', {'intent': 'alphabet', 'reason': 'cut o'}),
+    ('```json\n{"a": {"b": 1', {'a': {'b': 1}}),
+], ids=['open list', 'open string', 'open object'])
+def test_truncated_objects_are_closed(text, expected):
+    assert extract_json(text) == expected
+
+
+@pytest.mark.parametrize('text', ['', 'no json here', '```json\n```', '{"a": }'])
+def test_nothing_to_extract(text):
+    assert extract_json(text) is None
+
+
+def test_chunks_give_the_same_result():
+    text = '```json\n{"intent": "alphabet", "reason": "mentions "Verily", a bet",\n "n": [1, 2,]}\n```'
+    for size in (1, 3, 7):
+        extractor = JsonExtractor()
+        results = [extractor.feed(text[i:i + size]) for i in range(0, len(text), size)]
+        assert extractor.finish() == extract_json(text)
+        # Available as soon as the closing brace arrived, before the rest of the text
+        assert results.index(extract_json(text)) < len(results) - 1
+
+
+def test_cleanup_json_returns_repaired_text():
+    assert json.loads(cleanup_json('x {"a": 1,} y')) == {'a': 1}
+    assert cleanup_json('nothing') is None
+
+
+def test_corpus():
+    # Every model output in the benchmark corpus that has an object in it gives its intent
+    with open(CORPUS) as f:
+        texts = [json.loads(line)['text'] for line in f if line.strip()]
+    for text in texts:
+        result = extract_json(text)
+        if '{' in text:
+            assert result['intent'] in ('alphabet', 'other'), text
+        else:
+            assert result is None
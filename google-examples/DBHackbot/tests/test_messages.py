@@ -0,0 +1,87 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from util.messages import MessageLog, MessageStore, Message, sign_session, verify_session
+
+TEXT = 'x' * 200
+
+
+def texts(messages):
+    return [message.text.rstrip('x') for message in messages]
+
+
+def fill(store, count, prefix='m'):
+    for i in range(count):
+        store.append('user', f'{prefix}{i}' + TEXT)
+
+
+def test_older_messages_come_from_the_log(tmp_path):
+    store = MessageStore('s', MessageLog(str(tmp_path / 'log.sqlite')), cap=1000)
+    fill(store, 10)
+    assert store.first > 0
+    assert texts(store.page(0)) == [f'm{i}' for i in range(10)]
+    assert texts(store.page(2, 5)) == ['m2', 'm3', 'm4']
+
+
+def test_pages_stay_put_when_old_messages_expire(tmp_path):
+    log = MessageLog(str(tmp_path / 'log.sqlite'))
+    store = MessageStore('s', log, cap=1000)
+    fill(store, 10)
+    log.db.execute('DELETE FROM transcripts WHERE id <= 2')
+    # The page right before the messages in memory is still the same
+    first = store.first
+    assert texts(store.page(first - 2, first)) == [f'm{first - 2}', f'm{first - 1}']
+
+
+def test_messages_of_another_tab(tmp_path):
+    log = MessageLog(str(tmp_path / 'log.sqlite'))
+    tab, other = MessageStore('s', log, cap=1000), MessageStore('s', log, cap=1000)
+    for i in range(6):
+        tab.append('user', f'a{i}' + TEXT)
+        other.append('user', f'b{i}' + TEXT)
+    # The older messages are the ones logged right before the oldest one in memory, whichever tab wrote them
+    logged = texts(log.read('s'))
+    oldest = logged.index(texts(tab.recent)[0])
+    assert texts(tab.page(0)) == logged[oldest - tab.first:oldest] + texts(tab.recent)
+
+
+def test_transcript_is_picked_up_again(tmp_path):
+    log = MessageLog(str(tmp_path / 'log.sqlite'))
+    fill(MessageStore('s', log, cap=1000), 5)
+    store = MessageStore('s', log, cap=1000)
+    assert len(store) == 5
+    assert texts(store.page(3)) == ['m3', 'm4']
+
+
+def test_memory_cap_without_log():
+    store = MessageStore('s', cap=2000)
+    fill(store, 50)
+    assert store.bytes <= 2000
+    assert len(store) == len(store.recent) < 50
+    assert texts(store.page(0))[-1] == 'm49'
+
+
+def test_newest_message_always_stays():
+    store = MessageStore('s', cap=10)
+    store.append('chatbot', TEXT)
+    assert len(store) == 1 and store.page(0)[0].text == TEXT
+
+
+def test_signed_session_ids():
+    signed = sign_session('abc')
+    assert verify_session(signed) == 'abc'
+    assert verify_session('abc') is None
+    assert verify_session(signed[:-1] + ('0' if signed[-1] != '0' else '1')) is None
+    assert verify_session('other' + signed[3:]) is None
+    assert Message('user').id is None
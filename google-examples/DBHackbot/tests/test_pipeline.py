@@ -0,0 +1,110 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from types import SimpleNamespace
+from google.cloud import discoveryengine_v1alpha as discoveryengine
+from google.longrunning import operations_pb2
+from util.pipeline import Stage, Pipeline
+
+
+class FakeOperation:
+    """A long running operation that is done right away, with a result or an error"""
+
+    def __init__(self, name, result=None, error=None):
+        self.operation = SimpleNamespace(name=name)
+        self._result = result
+        self.error = error
+
+    def done(self):
+        return True
+
+    def result(self):
+        if self.error:
+            raise RuntimeError(self.error)
+        return self._result
+
+
+def proto_operation(name, response=None, error=None):
+    # What get_operation returns for an operation of an earlier run
+    operation = operations_pb2.Operation(name=name, done=True)
+    if error:
+        operation.error.code = 13
+        operation.error.message = error
+    else:
+        operation.response.Pack(type(response).pb(response))
+    return operation
+
+
+def pipeline(state_file, stages, operations=None):
+    return Pipeline(stages, state_file=str(state_file), get_operation=lambda name: operations[name], poll_start=0.01)
+
+
+def test_results_are_passed_on(tmp_path):
+    stages = [Stage('a', lambda results: 1), Stage('b', lambda results: results['a'] + 1, depends=('a',))]
+    runner = pipeline(tmp_path / 'state.json', stages)
+    assert runner.run()
+    assert runner.results() == {'a': 1, 'b': 2}
+    assert not (tmp_path / 'state.json').exists()
+
+
+def test_failed_operation_is_started_again(tmp_path):
+    state_file = tmp_path / 'state.json'
+    started = []
+    def run(results):
+        started.append(1)
+        return FakeOperation(f'op-{len(started)}', error='import failed' if len(started) == 1 else None)
+    stages = [Stage('import', run, on_done=lambda response: 'imported')]
+    assert not pipeline(state_file, stages).run()
+    assert json.loads(state_file.read_text())['import']['status'] == 'failed'
+    assert pipeline(state_file, stages).run()
+    assert len(started) == 2
+
+
+def test_failed_resumed_operation_is_started_again(tmp_path):
+    state_file = tmp_path / 'state.json'
+    state_file.write_text(json.dumps({'import': {'status': 'running', 'operation': 'op-0'}}))
+    operations = {'op-0': proto_operation('op-0', error='import failed')}
+    started = []
+    def run(results):
+        started.append(1)
+        return FakeOperation('op-1')
+    stages = [Stage('import', run, on_done=lambda response: 'imported')]
+    assert not pipeline(state_file, stages, operations).run()
+    assert not started
+    assert pipeline(state_file, stages, operations).run()
+    assert len(started) == 1
+
+
+def test_resumed_operation_has_its_response(tmp_path):
+    state_file = tmp_path / 'state.json'
+    state_file.write_text(json.dumps({'import': {'status': 'running', 'operation': 'op-1'}}))
+    response = discoveryengine.ImportDocumentsResponse(error_samples=[{'code': 3, 'message': 'bad document'}])
+    operations = {'op-1': proto_operation('op-1', response)}
+    errors = []
+    def never_run(results):
+        raise AssertionError('the operation of the earlier run is picked up')
+    stages = [Stage('import', never_run, on_done=lambda response: errors.append(len(response.error_samples)),
+                    response_type=discoveryengine.ImportDocumentsResponse)]
+    assert pipeline(state_file, stages, operations).run()
+    assert errors == [1]
+
+
+def test_dependents_of_a_failed_stage_are_skipped(tmp_path):
+    def fail(results):
+        raise RuntimeError('no')
+    ran = []
+    stages = [Stage('a', fail), Stage('b', lambda results: ran.append(1), depends=('a',))]
+    assert not pipeline(tmp_path / 'state.json', stages).run()
+    assert not ran
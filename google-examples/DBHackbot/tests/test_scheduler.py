@@ -0,0 +1,91 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import pytest
+from util.scheduler import Scheduler, Overloaded, INTERACTIVE, BACKGROUND, TOO_FAST
+
+
+def queue(scheduler, until, served, name, priority=INTERACTIVE, session=None):
+    # A caller waiting for a slot: notes when it got it and hands it on right away
+    waiting = scheduler.waiting
+    def run():
+        release = scheduler.acquire(priority, session)
+        served.append(name)
+        release()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert until(lambda: scheduler.waiting == waiting + 1)
+    return thread
+
+
+def test_timeout_removes_waiter():
+    scheduler = Scheduler(max_concurrent=1, turns_per_minute=0)
+    release = scheduler.acquire()
+    with pytest.raises(TimeoutError):
+        scheduler.acquire(session='s', timeout=0.05)
+    assert scheduler.waiting == 0
+    assert not scheduler.queues[INTERACTIVE]
+    release()
+    assert scheduler.running == 0
+
+
+def test_release_more_than_once():
+    scheduler = Scheduler(max_concurrent=2, turns_per_minute=0)
+    release = scheduler.acquire()
+    release()
+    release()
+    assert scheduler.running == 0
+
+
+def test_background_after_interactive(until):
+    scheduler = Scheduler(max_concurrent=1, turns_per_minute=0)
+    release = scheduler.acquire()
+    served = []
+    threads = [queue(scheduler, until, served, 'background', BACKGROUND, 'a'),
+               queue(scheduler, until, served, 'interactive a', INTERACTIVE, 'a'),
+               queue(scheduler, until, served, 'interactive b', INTERACTIVE, 'b')]
+    release()
+    for thread in threads:
+        thread.join(timeout=3)
+    assert served == ['interactive a', 'interactive b', 'background']
+    assert scheduler.running == 0 and scheduler.waiting == 0
+
+
+def test_sessions_take_turns(until):
+    scheduler = Scheduler(max_concurrent=1, turns_per_minute=0)
+    release = scheduler.acquire()
+    served = []
+    threads = [queue(scheduler, until, served, name, session=name[0]) for name in ('a1', 'a2', 'b1')]
+    release()
+    for thread in threads:
+        thread.join(timeout=3)
+    assert served == ['a1', 'b1', 'a2']
+
+
+def test_full_queue():
+    scheduler = Scheduler(max_concurrent=1, max_queued=0, turns_per_minute=0)
+    release = scheduler.acquire()
+    with pytest.raises(Overloaded):
+        scheduler.acquire()
+    assert scheduler.acquire(block=False) is None
+    release()
+
+
+def test_turns_per_session():
+    scheduler = Scheduler(turns_per_minute=6, burst=2)
+    assert scheduler.admit('a') is None
+    assert scheduler.admit('a') is None
+    assert scheduler.admit('a') == TOO_FAST
+    assert scheduler.admit('b') is None
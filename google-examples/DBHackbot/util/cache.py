@@ -0,0 +1,169 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Answer cache shared by all sessions of a process.
+# Only turns on a fresh session are cached: any answer after that was generated with the
+# history of that session and may mention it. Everybody asking "What is the business model
+# of alphabet?" on a fresh session gets the same answer.
+# Below it, the retrieval cache keeps search results, optionally in SQLite so that several
+# processes and restarts share them.
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from util.stream import when_hydrated
+
+
+def normalize(query: str) -> str:
+    """Lower case, single spaces, no trailing punctuation"""
+    return re.sub(r'\s+', ' ', query.lower()).strip().rstrip('?!. ')
+
+def history_fingerprint(history: str, query: str):
+    """Fingerprint of the part of the history the answer depends on.
+    '' on a fresh session, None otherwise: the answer was generated with the history and must not go to other sessions.
+    """
+    if history.strip():
+        return None
+    return ''
+
+def copy_response(response: dict) -> dict:
+    return {'response': response.get('response', ''), 'documents': [dict(doc) for doc in response.get('documents', [])]}
+
+
+class AnswerCache:
+    """Thread safe LRU cache with time to live for handle_query results"""
+
+    def __init__(self, max_size=1000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, query: str, intent: str, history: str):
+        """Returns the cache key or None if this turn must not be cached"""
+        fingerprint = history_fingerprint(history, query)
+        if fingerprint is None:
+            return None
+        return hashlib.sha1(f'{intent}\n{fingerprint}\n{normalize(query)}'.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns a copy of the cached response or None"""
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            if entry and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return copy_response(entry[1])
+
+    def put(self, key, response: dict):
+        # Failed answers (and messages like "try again later") are not cached
+        if not key or not response.get('response') or response.get('error') or response['response'].lstrip().startswith('Oh no!'):
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, copy_response(response))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def put_when_done(self, key, response: dict):
+        """Caches the response. A streaming response is cached once its stream is exhausted,
+        documents built in the background (util.stream.hydrate) once they are there."""
+        if not key:
+            return response
+        return when_hydrated(response, lambda r: self.put(key, r))
+
+    def contains_query(self, query: str, history: str) -> bool:
+        """Is there an answer for this query under any intent?"""
+        return any(self.get_quiet(self.key(query, intent, history)) for intent in ('alphabet', 'other'))
+
+    def get_quiet(self, key) -> bool:
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
+class RetrievalCache:
+    """Thread safe LRU cache with time to live for search results ({'response', 'documents'}).
+
+    Args:
+        max_size (int): Entries kept in memory
+        ttl (int): Seconds an entry is valid
+        path (str): Optional SQLite file shared with other processes, entries found there are copied into memory
+    """
+
+    def __init__(self, max_size=1000, ttl=3600, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (expires, generation, response)
+        self.lock = threading.Lock()
+        self.db = None
+        self.puts = 0
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS retrieval (key TEXT PRIMARY KEY, expires REAL, generation TEXT, response TEXT)')
+
+    @staticmethod
+    def key(query: str, *spec) -> str:
+        """Key for a query and everything else the result depends on (backend, serving config, search spec)"""
+        return hashlib.sha1('\n'.join([normalize(query)] + [str(s) for s in spec]).encode()).hexdigest()
+
+    def get(self, key, generation=''):
+        """Returns a copy of the cached response or None.
+        Entries of another generation (written before the last datastore import) don't count."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db:
+                row = self.db.execute('SELECT expires, generation, response FROM retrieval WHERE key = ?', (key,)).fetchone()
+                if row:
+                    entry = (row[0], row[1], json.loads(row[2]))
+                    self._remember(key, entry)
+            if entry is None or entry[0] < now or entry[1] != generation:
+                return None
+            self.entries.move_to_end(key)
+        return copy_response(entry[2])
+
+    def put(self, key, response: dict, generation=''):
+        entry = (time.time() + self.ttl, generation, copy_response(response))
+        with self.lock:
+            self._remember(key, entry)
+            if self.db:
+                self.db.execute('INSERT OR REPLACE INTO retrieval VALUES (?, ?, ?, ?)', (key, entry[0], generation, json.dumps(entry[2])))
+                self.puts += 1
+                if self.puts % 100 == 0:
+                    self.db.execute('DELETE FROM retrieval WHERE expires < ?', (time.time(),))
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
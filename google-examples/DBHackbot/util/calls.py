@@ -0,0 +1,228 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Calls to Gemini and Vertex AI Search with deadlines, retries and hedging.
+# Every turn has a deadline (with_deadline), every call gets the timeout of its stage
+# but never more than what is left of the turn. Errors that may go away (overload,
+# server errors, timeouts) are retried after a jittered backoff. A call taking longer
+# than 95% of the recent calls of its stage gets a duplicate, the first answer wins.
+# The slow tail mostly comes from single requests stuck somewhere, the duplicate usually isn't.
+# Every request needs a slot of the scheduler (util/scheduler.py), a stream keeps its slot
+# until it has ended. Hedges only go out if a slot is free right away.
+
+import contextlib
+import contextvars
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from google.api_core import exceptions
+from util import metrics
+from util.llm import singleton
+from util.scheduler import get_scheduler, current_session, current_priority, INTERACTIVE, BACKGROUND
+from util.settings import TURN_DEADLINE, CALL_TIMEOUTS, CALL_RETRIES, HEDGING
+
+RETRYABLE = (exceptions.TooManyRequests, exceptions.ServerError, ConnectionError, TimeoutError)
+BACKOFF = 0.25          # seconds before the first retry, doubled for every further one
+HEDGE_SAMPLES = 20      # calls of a stage needed before hedging starts
+HEDGE_MIN = 0.05        # never hedge earlier than this (seconds)
+BACKGROUND_STAGES = {'summary'}   # nobody is waiting for these, whoever made the call
+UNHEDGED_STAGES = {'context_cache'}   # a duplicate would be a second cache, paid for
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+_latencies = {}         # stage -> recent latencies of successful calls
+_lock = threading.Lock()
+_END = object()
+
+
+# The calls run in their own pool, so a call can be waited for with a timeout and hedged
+@singleton
+def get_call_executor():
+    return ThreadPoolExecutor(max_workers=64, thread_name_prefix='call')
+
+@contextlib.contextmanager
+def with_deadline(seconds=TURN_DEADLINE):
+    """Sets the deadline of the turn for the calls in this context (and in threads started with metrics.bind)"""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining(deadline=None) -> float:
+    """Seconds left until the deadline of the turn, infinite outside of a turn"""
+    deadline = deadline or _deadline.get()
+    return deadline - time.monotonic() if deadline else math.inf
+
+def budget(stage, deadline=None) -> float:
+    """Timeout for the next call of a stage: its own timeout, but not more than is left of the turn"""
+    return min(CALL_TIMEOUTS.get(stage, TURN_DEADLINE), remaining(deadline))
+
+def retryable(e) -> bool:
+    return isinstance(e, RETRYABLE)
+
+def hedge_delay(stage):
+    """95th percentile of the recent successful calls of the stage, None while there are too few"""
+    with _lock:
+        recent = sorted(_latencies.get(stage, ()))
+    if len(recent) < HEDGE_SAMPLES:
+        return None
+    return max(HEDGE_MIN, recent[int(len(recent) * 0.95)])
+
+def _record(stage, seconds):
+    with _lock:
+        _latencies.setdefault(stage, deque(maxlen=200)).append(seconds)
+
+def _drop(futures, on_lost):
+    # Losing requests: cancel if not yet started, otherwise throw away their result
+    for future in futures:
+        if not future.cancel():
+            future.add_done_callback(lambda f: f.exception() or on_lost(f.result()))
+
+def _submit(stage, function, args, kwargs, stream, session, priority, timeout, block=True):
+    # Starts a request once the scheduler has a slot for it, None if block is False and there is none
+    priority = BACKGROUND if stage in BACKGROUND_STAGES else priority
+    release = get_scheduler().acquire(priority, session, timeout=timeout, block=block)
+    if release is None:
+        return None
+    try:
+        if stream:
+            future = get_call_executor().submit(metrics.bind(_open_stream), function, args, kwargs, release)
+            # A stream that started releases its slot itself once it has ended
+            future.add_done_callback(lambda f: (f.cancelled() or f.exception()) and release())
+        else:
+            future = get_call_executor().submit(metrics.bind(function), *args, **kwargs)
+            future.add_done_callback(lambda f: release())
+    except Exception:
+        release()
+        raise
+    return future
+
+def _attempt(stage, function, args, kwargs, timeout, stream, session, priority, on_lost):
+    # One attempt, with a hedged duplicate if the first request is slower than usual
+    end = time.monotonic() + timeout
+    pending = {_submit(stage, function, args, kwargs, stream, session, priority, timeout)}
+    delay = hedge_delay(stage) if HEDGING and stage not in UNHEDGED_STAGES else None
+    if delay is not None and delay < end - time.monotonic():
+        done, _ = wait(pending, timeout=delay)
+        if not done and (hedge := _submit(stage, function, args, kwargs, stream, session, priority, timeout, block=False)):
+            metrics.event(f'{stage}_hedge')
+            pending.add(hedge)
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                # First answer wins
+                _drop(pending, on_lost)
+                return future.result()
+            error = error or future.exception()
+    if pending or error is None:
+        _drop(pending, on_lost)
+        raise TimeoutError(f'{stage} did not answer within {timeout:.1f}s')
+    raise error
+
+def _call(stage, function, args, kwargs, deadline, session, priority=INTERACTIVE, stream=False, on_lost=lambda result: None):
+    attempt = 0
+    while True:
+        timeout = budget(stage, deadline)
+        if timeout <= 0:
+            raise TimeoutError(f'No time left for {stage}')
+        start = time.monotonic()
+        try:
+            result = _attempt(stage, function, args, kwargs, timeout, stream, session, priority, on_lost)
+            _record(stage, time.monotonic() - start)
+            return result
+        except Exception as e:
+            if attempt >= CALL_RETRIES or not retryable(e) or remaining(deadline) <= 0:
+                raise
+            attempt += 1
+            metrics.event(f'{stage}_retry')
+            print(f'Retrying {stage} after: {e}')
+            time.sleep(min(BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5), max(0, remaining(deadline))))
+
+def call(stage, function, *args, **kwargs):
+    """Calls function(*args, **kwargs) within the deadline of the turn, with retries and hedging.
+
+    Args:
+        stage (str): Stage of the call, selects the timeout (CALL_TIMEOUTS) and the latency statistics for hedging
+
+    Returns:
+        Whatever function returns. Raises the last error, or TimeoutError if there was no answer in time.
+    """
+    return _call(stage, function, args, kwargs, _deadline.get(), current_session(), current_priority())
+
+class _Stream:
+    # The rest of a stream, releases the scheduler slot when it ends, fails or is dropped
+    __slots__ = ('chunks', 'release')
+
+    def __init__(self, chunks, release):
+        self.chunks = chunks
+        self.release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.chunks)
+        except BaseException:
+            self.release()
+            raise
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+def _open_stream(function, args, kwargs, release):
+    # A stream counts as answered once its first chunk is there
+    chunks = iter(function(*args, **kwargs))
+    first = next(chunks, _END)
+    if first is _END:
+        release()
+    return first, _Stream(chunks, release)
+
+def _close_stream(opened):
+    opened[1].close()
+
+def call_stream(stage, function, *args, **kwargs):
+    """Like call() for functions returning a stream (generate_content(..., stream=True)).
+    The deadline, retries and hedging apply until the first chunk arrives.
+    The call starts when the returned generator is iterated, with the deadline, session and priority of the turn it was created in.
+
+    Yields:
+        The chunks of the stream
+    """
+    deadline = _deadline.get()
+    session = current_session()
+    priority = current_priority()
+    def chunks():
+        first, rest = _call(stage, function, args, kwargs, deadline, session, priority, stream=True, on_lost=_close_stream)
+        if first is _END:
+            return
+        try:
+            yield first
+            yield from rest
+        finally:
+            rest.close()
+    return chunks()
@@ -13,29 +13,62 @@
 # limitations under the License.
 
 import streamlit as st
+import uuid
+from util.messages import MessageLog, MessageStore, sign_session, verify_session
+from util.settings import CHAT_WINDOW, SESSION_STORE, SESSION_RETENTION_DAYS
 
 user_avatar = 'assets/user.png'
 assistant_avatar = 'assets/assistant.png'
 icons = {"chatbot": assistant_avatar,
          'user': user_avatar}
 
-# Each chat message is a dict
-# { 'text': str, 'content': <any other data type that st.write accepts> }
+# Each chat message is a util.messages.Message
+# role, text: str, content: <any other data type that st.write accepts, or the bytes of an image>
+# st.session_state.messages is the MessageStore of the session
+
+# One log for all sessions of the process
+@st.cache_resource
+def get_message_log():
+    if not SESSION_STORE:
+        return None
+    log = MessageLog(SESSION_STORE)
+    log.start_expiry(SESSION_RETENTION_DAYS)
+    return log
+
+def session_id():
+    # The signed id is kept in the url, so a reload (also after a restart) finds the transcript again.
+    # An id without a valid signature starts a new session.
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = verify_session(st.query_params.get('session')) or uuid.uuid4().hex
+        st.query_params['session'] = sign_session(st.session_state.session_id)
+    return st.session_state.session_id
 
 def prepare_chat():
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        st.session_state.messages = MessageStore(session_id(), get_message_log())
 
 def write_chat(message):
-    if message.get("text"):
-        st.markdown(message["text"])
-    if "content" in message:
-        st.write(message["content"])
+    if message.text:
+        st.markdown(message.text)
+    if isinstance(message.content, bytes):
+        # Thumbnail of an image sent with the question
+        st.image(message.content)
+    elif message.content is not None:
+        st.write(message.content)
 
 def display_chat_message(message):
-    with st.chat_message(message["role"], avatar=icons[message["role"]]):
+    with st.chat_message(message.role, avatar=icons[message.role]):
         write_chat(message)
 
+# Only the newest messages are shown, older ones are loaded a page at a time on request.
+# This keeps the work per rerun (and what is sent to the browser) independent of the length of the chat.
+def show_earlier_messages():
+    st.session_state.chat_shown = st.session_state.get('chat_shown', CHAT_WINDOW) + CHAT_WINDOW
+
 def display_chat():
-    for message in st.session_state.messages:
+    messages = st.session_state.messages
+    start = max(0, len(messages) - st.session_state.get('chat_shown', CHAT_WINDOW))
+    if start > 0:
+        st.button(f"Show earlier messages ({start} more)", key="show_earlier", on_click=show_earlier_messages)
+    for message in messages.page(start):
         display_chat_message(message)
@@ -0,0 +1,67 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Thin client for the chat engine service (python -m util.engine).
+# Returns the same response dicts as util.engine.handle_query, so the UI
+# does not care where the answer comes from.
+
+import base64
+import http.client
+import json
+from urllib.parse import urlsplit
+
+
+class RemoteEngine:
+
+    def __init__(self, url: str, timeout=300):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+
+    def handle_query(self, query: str, session_id: str, image: bytes = None) -> dict:
+        """Sends the query (and the image it is about) to the engine.
+
+        Returns:
+            dict: {'response': '', 'documents': [], 'stream': generator of str}
+                'response' and 'documents' are complete once the stream is exhausted
+        """
+        response = {'response': '', 'documents': []}
+        response['stream'] = self._stream(query, session_id, image, response)
+        return response
+
+    def _stream(self, query, session_id, image, response):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            request = {'session': session_id, 'query': query}
+            if image:
+                request['image'] = base64.b64encode(image).decode()
+            body = json.dumps(request)
+            connection.request('POST', '/ask', body=body, headers={'Content-Type': 'application/json'})
+            http_response = connection.getresponse()
+            if http_response.status != 200:
+                raise http.client.HTTPException(f'chat engine answered {http_response.status}')
+            while line := http_response.readline():
+                event = json.loads(line)
+                if 'text' in event:
+                    response['response'] += event['text']
+                    yield event['text']
+                else:
+                    response.update(event)
+        except Exception as e:
+            text = f'Oh no! A problem occurred:\n{str(e)}\n'
+            response['response'] += text
+            yield text
+        finally:
+            connection.close()
@@ -13,17 +13,160 @@
 # limitations under the License.
 
 
-def following_char(i: int, s: str) -> str:
-    '''
-    Find next character that is not whitespace.
-    '''
-    i += 1
-    while i < len(s) and s[i].isspace():
-        i += 1
-    if i < len(s):
-        return s[i]
-    else:
-        return ''
+import json
+
+_CLOSERS = ':}]'
+_VALUE_START = '"{[]}-0123456789'
+_LITERALS = ('true', 'false', 'null')
+_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+
+class JsonExtractor:
+    """Single pass, repairing extractor for a JSON object in LLM output.
+
+    Skips everything before the first '{' (code fences, chatter), escapes quotes inside
+    strings that the model forgot to escape, escapes raw newlines in strings, drops trailing
+    commas and stops at the brace that closes the first object. Text can be fed in chunks
+    as it is generated; the object is available as soon as its closing brace arrived.
+
+    A quote inside a string is taken as the end of the string if the next non-whitespace
+    character is one of : } ], a line break or the end of the text, or if it is a comma followed by
+    something that can start the next key or value. Otherwise it is a quote within the text.
+    If the text ends before the object is closed, the missing quote and brackets are added.
+    """
+
+    def __init__(self):
+        self.text = ''          # text not looked at yet
+        self.out = []           # repaired JSON so far
+        self.started = False
+        self.open = []          # closing brackets we still expect
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+        self.result = None
+
+    def feed(self, chunk: str, final: bool = False):
+        """Adds text. Returns the parsed object once it is complete, otherwise None."""
+        if self.done:
+            return self.result
+        self.text += chunk
+        self._run(final)
+        return self.result
+
+    def finish(self):
+        """No more text is coming. Returns the parsed object or None."""
+        return self.feed('', final=True)
+
+    def repaired(self):
+        """The repaired JSON string, None if the object is not complete"""
+        return ''.join(self.out) if self.done else None
+
+    def _run(self, final):
+        text, out, n = self.text, self.out, len(self.text)
+        i = 0
+        if not self.started:
+            i = text.find('{')
+            if i == -1:
+                self.text = ''
+                return
+            self.started = True
+        while i < n:
+            c = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                    out.append(c)
+                elif c == '\\':
+                    self.escaped = True
+                    out.append(c)
+                elif c == '"':
+                    closing = self._closes_string(text, i + 1, final)
+                    if closing is None:
+                        break  # can't tell yet whether this quote ends the string
+                    if closing:
+                        self.in_string = False
+                        out.append(c)
+                    else:
+                        out.append('\\"')
+                else:
+                    out.append(_ESCAPES.get(c, c))
+            elif c == '"':
+                self.in_string = True
+                out.append(c)
+            elif c in '{[':
+                self.open.append('}' if c == '{' else ']')
+                out.append(c)
+            elif c in '}]':
+                self._close(c)
+                if not self.open:
+                    self.done = True
+                    i += 1
+                    break
+            elif c == '`':
+                final = True  # closing code fence, the model stopped before the object was complete
+                break
+            elif not c.isspace():
+                out.append(c)
+            i += 1
+        if final and not self.done:
+            # Truncated output: close what is still open
+            if self.in_string:
+                out.append('"')
+            while self.open:
+                self._close(self.open[-1])
+            self.done = True
+        self.text = text[i:] if not self.done else ''
+        if self.done:
+            try:
+                self.result = json.loads(''.join(out))
+            except ValueError:
+                self.result = None
+
+    def _closes_string(self, text, j, final):
+        """Does the quote before text[j] end the string? None if we need more text to tell."""
+        n = len(text)
+        newline = False
+        while j < n and text[j].isspace():
+            newline = newline or text[j] == '\n'
+            j += 1
+        if j == n:
+            return True if final else None
+        if newline or text[j] in _CLOSERS:
+            return True
+        if text[j] != ',':
+            return False
+        j += 1
+        while j < n and text[j].isspace():
+            j += 1
+        if j == n:
+            return True if final else None
+        if text[j] in _VALUE_START:
+            return True
+        rest = text[j:j + 5]
+        if any(rest.startswith(literal) for literal in _LITERALS):
+            return True
+        if not final and any(literal.startswith(rest) for literal in _LITERALS):
+            return None
+        return False
+
+    def _close(self, c):
+        while self.out and (self.out[-1] == ',' or self.out[-1].isspace()):
+            self.out.pop()
+        self.out.append(c)
+        if self.open:
+            self.open.pop()
+
+
+def extract_json(x: str):
+    """Finds and parses the JSON object in a string (e.g. LLM output).
+
+    Args:
+        x (str): String containing a JSON structure. May contain leading and trailing characters outside of JSON.
+
+    Returns:
+        dict: The parsed object. None if no valid object could be found.
+    """
+    return JsonExtractor().feed(x, final=True)
 
 
 def cleanup_json(x: str):
@@ -35,38 +178,6 @@ def cleanup_json(x: str):
     Returns:
         str: Retuns the substring representig the JSON structure. Returns None if JSON could not be found.
     """
-    startBrace = x.find('{')
-    if startBrace == -1:
-        return None
-    endBrace = x.rfind('}')
-    if endBrace == -1:
-        return None
-    if startBrace > endBrace:
-        return None
-    the_json = x[startBrace:endBrace+1].replace('\n', ' ')
-    # Now check for unescaped '"' characters
-    inquote = False
-    i = 0 
-    while i < len(the_json):
-        if the_json[i] == '"' and (i == 0 or the_json[i-1] != '\\'):
-            if inquote:
-                if following_char(i, the_json).isalpha():
-                    # Looks like quoting inside a string
-                    # We must escape this quote and the next
-                    the_json = the_json[0:i] + '\\' + the_json[i:]
-                    i += 2
-                    while the_json[i] != '"' and i < len(the_json):
-                        i += 1
-                    if i < len(the_json):
-                        the_json = the_json[0:i] + '\\' + the_json[i:]
-                        i += 2
-                else:
-                    inquote = False
-                    i += 1
-            else:
-                inquote = True
-                i += 1
-        else:
-            i += 1
-    return the_json
-
+    extractor = JsonExtractor()
+    extractor.feed(x, final=True)
+    return extractor.repaired()
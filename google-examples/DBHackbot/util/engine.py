@@ -0,0 +1,441 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The chat engine: intent detection, answering and everything around it.
+# It does not depend on Streamlit and can be used in three ways:
+#   - in process, main.py calls handle_query() with the session's History
+#   - asynchronously, ChatEngine.stream()/ask() for batch jobs and load tests
+#   - as a local HTTP service, python -m util.engine, with util/client.py as the thin client
+# All sessions share the same model, clients, thread pool and answer cache.
+
+import asyncio
+import base64
+import json
+import re
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from util import metrics, prompts
+from util.batching import MicroBatcher
+from util.cache import AnswerCache
+from util.calls import call, call_stream, with_deadline, remaining, budget
+from util.docsnsnips import JsonExtractor
+from util.history import History
+from util.images import prepare_image, ImageError
+from util.intent import classify, log_decision
+from util.llm import get_model, singleton
+from util.prefab import PrefabAnswers
+from util.rag import search_engine
+from util.scheduler import get_scheduler, for_session, Overloaded, BACKGROUND
+from util.settings import STREAMING, SPECULATION, CACHE_SIZE, CACHE_TTL, HISTORY_BUDGET, INTENT_HISTORY_BUDGET, ENGINE_PORT, TURN_DEADLINE, DEGRADE_BELOW
+from util.settings import INTENT_BATCHING, INTENT_BATCH_SIZE, INTENT_BATCH_WINDOW_MS, PREFAB_QUESTIONS, PREFAB_REFRESH
+from util.stream import stream_response, prefetch, discard, chunk_text, when_done, documents, consume, started
+from vertexai.preview.generative_models import GenerationConfig, Part
+
+
+# One thread pool per process, shared by all sessions
+@singleton
+def get_executor():
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix='chat')
+
+# One answer cache per process, shared by all sessions
+@singleton
+def get_answer_cache():
+    return AnswerCache(max_size=CACHE_SIZE, ttl=CACHE_TTL)
+
+def ask_gemini(history, query, image=None, temperature=1, stream=STREAMING):
+    model, contents = prompts.companion.prepare(history, query, image)
+    generation_config = GenerationConfig(candidate_count=1, max_output_tokens=2048, temperature=temperature)
+    # Answers about images take longer, they get their own timeout and statistics
+    stage = 'generation_image' if image else 'generation'
+    response = {'response': ''}
+    if stream:
+        # The answer arrives chunk by chunk while the caller iterates response['stream']
+        try:
+            chunks = call_stream(stage, model.generate_content, contents, stream=True, generation_config=generation_config)
+        except Exception as e:
+            metrics.error(stage, e)
+            chunks = []
+            response['response'] = f'Oh no! A problem occurred:\n{str(e)}\n'
+            response['error'] = True
+        response['stream'] = stream_response(chunks, response, stage=stage)
+        return response
+    try:
+        with metrics.span(stage):
+            gen_response = call(stage, model.generate_content, contents, stream=False, generation_config=generation_config)
+        metrics.usage(stage, gen_response)
+        response['response'] += gen_response.text
+    except Exception as e:
+        response['response'] = str(e) if getattr(e, 'friendly', False) else f'Oh no! A problem occurred:\n{str(e)}\n'
+        response['error'] = True
+    return response
+
+def summarize_history(summary, text):
+    llm_prompt = "Summarize the following conversation between a user and a chatbot in a few sentences. "\
+                 "Keep names, numbers and topics the user may refer back to.\n\n"
+    if summary:
+        llm_prompt += f"Summary of the conversation before:\n{summary}\n\n"
+    llm_prompt += f"Conversation:\n{text}\nSummary:"
+    generation_config = GenerationConfig(candidate_count=1, max_output_tokens=400, temperature=0)
+    with metrics.span('summary'):
+        gen_response = call('summary', get_model().generate_content, [Part.from_text(llm_prompt)], stream=False, generation_config=generation_config)
+    metrics.usage('summary', gen_response)
+    return gen_response.text
+
+def new_history():
+    """History for a new session"""
+    return History(budget=HISTORY_BUDGET, summarize=summarize_history, submit=get_executor().submit)
+
+def make_history(history: History, budget=None):
+    return history.render(budget)
+
+def get_intent(history, query):
+    with metrics.span('intent'):
+        intent = detect_intent(history, query)
+    metrics.event(f"intent_{intent['intent']}")
+    return intent
+
+def detect_intent(history, query):
+    # Confident cases are decided locally, the LLM only gets the rest
+    intent = classify(query, history)
+    if intent:
+        metrics.event('intent_local')
+        return intent
+    metrics.event('intent_llm')
+    # Batched or not, intent detection gets one intent budget
+    with with_deadline(budget('intent')):
+        return detect_intent_llm(history, query)
+
+def detect_intent_llm(history, query):
+    if INTENT_BATCHING:
+        try:
+            # Half of the budget at most, the rest is for asking on our own
+            intent = get_intent_batcher().submit((history, query)).result(timeout=remaining() / 2)
+        except Exception as e:
+            print(f'Exception during batched intent detection: {e}')
+            intent = None
+        if intent:
+            log_decision(query, intent)
+            return intent
+        # Alone in the batch or the batch failed: on our own, with what is left of the budget
+    model, contents = prompts.intent.prepare(history, query)
+    generation_config = GenerationConfig(candidate_count=1, max_output_tokens=400)
+    # Stream the result so we can stop reading as soon as the JSON object is complete
+    extractor = JsonExtractor()
+    text = ''
+    chunk = None
+    try:
+        for chunk in call_stream('intent', model.generate_content, contents, stream=True, generation_config=generation_config):
+            piece = chunk_text(chunk)
+            text += piece
+            if extractor.feed(piece) is not None:
+                break
+    except Exception as e:
+        metrics.error('intent', e)
+        print(f'Exception during detect intent: {e}')
+        return {'intent': 'other'}
+    metrics.usage('intent', chunk)
+    intent = extractor.finish()
+    if not isinstance(intent, dict):
+        metrics.error('intent')
+        print(f"ERROR - llm response parsing failed for '{text}'")
+        intent = {'intent': 'other'}
+        return intent
+    log_decision(query, intent)
+    return intent
+
+def parse_intents(text, count):
+    """Intents from the JSON array of a batched intent request, None for conversations missing in it"""
+    intents = [None] * count
+    try:
+        entries = json.loads(re.sub(r'^```(json)?|```$', '', text.strip()).strip())
+    except ValueError:
+        return intents
+    conflicting = set()
+    for entry in entries if isinstance(entries, list) else []:
+        if isinstance(entry, dict) and entry.get('intent') in ('alphabet', 'other') \
+                and type(entry.get('conversation')) is int and 1 <= entry['conversation'] <= count:
+            index = entry['conversation'] - 1
+            if intents[index] is not None and intents[index]['intent'] != entry['intent']:
+                conflicting.add(index)
+            intents[index] = {'intent': entry['intent']}
+    # Two different answers for the same conversation: neither counts
+    for index in conflicting:
+        intents[index] = None
+    return intents
+
+def detect_intents(items):
+    """Intents of several (history, query) pairs with a single LLM call, None where it failed"""
+    if len(items) == 1:
+        # Nothing to batch, the normal intent prompt is better
+        return [None]
+    # JSON-encoded, so nothing in a query can pass for the start of another conversation
+    conversations = json.dumps([{'conversation': i, 'history': history, 'query': query}
+                                for i, (history, query) in enumerate(items, start=1)], indent=1, ensure_ascii=False)
+    model, contents = prompts.intent_batch.prepare(conversations=conversations)
+    generation_config = GenerationConfig(candidate_count=1, max_output_tokens=100 + 30 * len(items), temperature=0)
+    response = call('intent', model.generate_content, contents, stream=False, generation_config=generation_config)
+    metrics.usage('intent_batch', response)
+    intents = parse_intents(chunk_text(response), len(items))
+    metrics.event('intent_batch_fallbacks', intents.count(None))
+    return intents
+
+# One intent batcher per process, shared by all sessions
+@singleton
+def get_intent_batcher():
+    return MicroBatcher(detect_intents, max_size=INTENT_BATCH_SIZE, window=INTENT_BATCH_WINDOW_MS / 1000, name='intent_batch')
+
+def speculate(answer, history, query):
+    # Streams are lazy, prefetch makes sure generation starts now
+    return prefetch(answer(history, query))
+
+def drop(future):
+    # The losing request: cancel if not yet started, otherwise throw away its result
+    if not future.cancel():
+        future.add_done_callback(lambda f: f.exception() or discard(f.result()))
+
+# -----------------------------------------------
+#  This is where the actual chat logic resides
+# -----------------------------------------------
+def handle_query(query, session_history: History, deadline=TURN_DEADLINE, session=None, image=None):
+    """Answers the query of a session.
+
+    Args:
+        query (str): Query from user
+        session_history (History): History of the session. The turn is added once the answer is complete.
+        deadline (float): Seconds the remote calls of this turn may take (until the answer starts streaming)
+        session: Id of the session for the scheduler, default: the history object
+        image (bytes): Image the query is about, as uploaded
+
+    Returns:
+        dict: {'response': (str) Answer text, 'documents': (list[dict]) List of documents}
+            and, for streamed answers, 'stream' (generator of str) - the other entries are complete when it is exhausted
+    """
+    session = session if session is not None else id(session_history)
+    # A prefab question on a fresh session costs nothing, even when we are busy
+    if not image and (response := prefab_answer(query, session_history, deadline)) is not None:
+        return finish_turn(session_history, query, response)
+    # Turned away right away if we are overloaded or the session asks too fast
+    if message := get_scheduler().admit(session):
+        return {'response': message, 'error': True}
+    with with_deadline(deadline), for_session(session):
+        try:
+            if image:
+                return answer_image_query(query, session_history, image)
+            return answer_query(query, session_history)
+        except Overloaded as e:
+            return {'response': str(e), 'error': True}
+
+def answer_query(query, session_history: History):
+    # We can do lots of stuff here: Find out user intent, generate SQL, generate pictures,
+    # search for information...
+    history = make_history(session_history)
+    intent_history = make_history(session_history, INTENT_HISTORY_BUDGET)
+    cache = get_answer_cache() if CACHE_TTL > 0 else None
+    if SPECULATION != 'off' and not (cache and cache.contains_query(query, history)):
+        response = handle_query_speculative(history, intent_history, query, cache)
+        return finish_turn(session_history, query, response)
+    intent = get_intent(intent_history, query)
+    key = cache.key(query, intent['intent'], history) if cache else None
+    if key and (response := cache.get(key)):
+        metrics.event('cache_hit')
+        return finish_turn(session_history, query, response)
+    if key:
+        metrics.event('cache_miss')
+    if intent['intent'] == 'alphabet':
+        #response = {'response': "It's RAG time!"}
+        response = search_or_ask(history, query)
+    else:
+        # We can also just ask Gemini
+        response = ask_gemini(history, query)
+    if cache:
+        response = cache.put_when_done(key, response)
+    return finish_turn(session_history, query, response)
+
+def answer_image_query(query, session_history: History, image):
+    # Questions about an image go to Gemini directly: the search can't look at the image,
+    # and the answer cache doesn't know it
+    try:
+        prepared = prepare_image(image)
+    except ImageError as e:
+        return {'response': str(e), 'error': True}
+    response = ask_gemini(make_history(session_history), query, prepared)
+    return finish_turn(session_history, f'{query} (with an image)', response)
+
+# Precomputed answers for the prefab questions, shared by all sessions
+@singleton
+def get_prefab_answers():
+    return PrefabAnswers(PREFAB_QUESTIONS, precompute_answer, PREFAB_REFRESH)
+
+def precompute_answer(query):
+    """Complete answer to a query on a fresh session"""
+    # Nobody is waiting for it: user turns get the scheduler's slots first
+    with with_deadline(TURN_DEADLINE), for_session('prefab', BACKGROUND):
+        response = consume(answer_query(query, new_history()))
+    docs = documents(response)
+    if response.get('error'):
+        raise RuntimeError(response.get('response'))
+    return {'response': response.get('response', ''), 'documents': docs}
+
+def prefab_answer(query, session_history: History, timeout=None):
+    """The precomputed answer if query is a prefab question asked on a fresh session, otherwise None"""
+    if PREFAB_REFRESH <= 0 or session_history.turns or session_history.summary:
+        return None
+    return get_prefab_answers().get(query, timeout)
+
+def search_or_ask(history, query):
+    # If retrieval fails outright, an answer without documents is better than none.
+    # A streamed answer is only taken once its first text is there, grounding fails in the stream.
+    if remaining() < DEGRADE_BELOW:
+        # Intent detection took most of the turn, no time left for searching, Gemini answers directly
+        metrics.event('retrieval_skipped')
+        return ask_gemini(history, query)
+    try:
+        response = search_engine(history, query)
+        if started(response):
+            return response
+        error = response.get('response', '').strip()
+    except Exception as e:
+        error = e
+    metrics.error('retrieval', error)
+    print(f'Retrieval failed, asking Gemini instead: {error}')
+    return ask_gemini(history, query)
+
+def handle_query_speculative(history, intent_history, query, cache=None):
+    # Start intent detection and the likely answer(s) at the same moment
+    # and keep the answer that matches the intent
+    executor = get_executor()
+    intent_future = executor.submit(metrics.bind(get_intent), intent_history, query)
+    answers = {'other': executor.submit(metrics.bind(speculate), ask_gemini, history, query)}
+    if SPECULATION == 'both':
+        answers['alphabet'] = executor.submit(metrics.bind(speculate), search_or_ask, history, query)
+    intent = intent_future.result()
+    winner = 'alphabet' if intent['intent'] == 'alphabet' else 'other'
+    metrics.event(f'speculation_{"hit" if winner in answers else "miss"}')
+    for kind, future in answers.items():
+        if kind != winner:
+            drop(future)
+    if winner in answers:
+        response = answers[winner].result()
+    else:
+        response = search_or_ask(history, query)
+    return cache.put_when_done(cache.key(query, winner, history), response) if cache else response
+
+def finish_turn(session_history: History, query, response):
+    # The turn goes into the history once the answer is complete
+    def record(response):
+        session_history.append("user", query)
+        session_history.append("chatbot", response.get('response', ''))
+    return when_done(response, record)
+
+
+_END = object()
+
+class ChatEngine:
+    """Asyncio API of the chat engine. Sessions are identified by an id, their histories live here."""
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+
+    def history(self, session_id) -> History:
+        """History of the session, sessions not used for a long time are dropped"""
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+        else:
+            self.sessions[session_id] = new_history()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return self.sessions[session_id]
+
+    async def stream(self, session_id, query, deadline=TURN_DEADLINE, image=None):
+        """Answers a query (about an image, if given as bytes), yields {'text': str} as the answer arrives
+        and finally {'response': str, 'documents': list} with the complete answer."""
+        loop = asyncio.get_running_loop()
+        history = self.history(session_id)
+        turn = metrics.start_turn()
+        response = await loop.run_in_executor(None, metrics.bind(handle_query), query, history, deadline, session_id, image)
+        if 'stream' in response:
+            queue = asyncio.Queue()
+            def pump(stream):
+                try:
+                    for text in stream:
+                        loop.call_soon_threadsafe(queue.put_nowait, text)
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, _END)
+            loop.run_in_executor(None, metrics.bind(pump), response.pop('stream'))
+            while (text := await queue.get()) is not _END:
+                yield {'text': text}
+        # Documents may still be built in the background (REFERENCES=lazy)
+        docs = await loop.run_in_executor(None, documents, response)
+        metrics.end_turn(turn)
+        yield {'response': response.get('response', ''), 'documents': docs}
+
+    async def ask(self, session_id, query, deadline=TURN_DEADLINE, image=None) -> dict:
+        """Answers a query, returns {'response': str, 'documents': list}"""
+        async for event in self.stream(session_id, query, deadline, image):
+            pass
+        return event
+
+    # Minimal HTTP/1.1 endpoint, so the Streamlit UI and other tools can share one engine
+    #   POST /ask {"session": str, "query": str, "deadline": seconds (optional), "image": base64 (optional)}
+    #       -> chunked NDJSON, one event of stream() per line
+    #   GET /health
+    #   GET /metrics -> metrics in the Prometheus text format (util/metrics.py)
+    async def handle_connection(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if method == 'GET' and path == '/health':
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok')
+            elif method == 'GET' and path == '/metrics':
+                text = metrics.prometheus().encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             + f'Content-Length: {len(text)}\r\nConnection: close\r\n\r\n'.encode() + text)
+            elif method == 'POST' and path == '/ask':
+                request = json.loads(body)
+                image = base64.b64decode(request['image']) if request.get('image') else None
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                             b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+                async for event in self.stream(request['session'], request['query'], request.get('deadline', TURN_DEADLINE), image):
+                    line = (json.dumps(event) + '\n').encode()
+                    writer.write(f'{len(line):X}\r\n'.encode() + line + b'\r\n')
+                    await writer.drain()
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+        except Exception as e:
+            print(f'Engine request failed: {e}')
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=ENGINE_PORT, workers=64):
+        # Blocking model calls and stream pumping run in this pool, the loop only moves bytes
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix='engine'))
+        if PREFAB_REFRESH > 0:
+            get_prefab_answers().start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f'Chat engine listening on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    # python -m util.engine [port]
+    asyncio.run(ChatEngine().serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else ENGINE_PORT))
@@ -0,0 +1,109 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Conversation history for the prompts.
+# Every turn is rendered once when it is added. A prompt gets the newest turns that fit
+# into its token budget, older turns are folded into a rolling summary. The summary is
+# written by a background task, so the chat turn never waits for it.
+
+import threading
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, Gemini averages about 4 characters per token"""
+    return len(text) // 4 + 1
+
+
+class History:
+
+    def __init__(self, budget=4000, summarize=None, submit=None):
+        """
+        Args:
+            budget (int): Token budget of the largest prompt. Turns beyond it get summarized.
+            summarize (callable): summarize(summary, text) -> new summary. None disables summaries.
+            submit (callable): Runs the summary in the background, e.g. executor.submit. Defaults to a thread.
+        """
+        self.budget = budget
+        self.summarize = summarize
+        self.submit = submit
+        self.turns = []     # (rendered line, tokens) of the turns not yet in the summary
+        self.summary = ''
+        self.summarized = 0 # number of turns covered by the summary, they are dropped from turns
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    def append(self, role: str, text: str):
+        line = f'{role}: {text}\n'
+        with self.lock:
+            self.turns.append((line, estimate_tokens(line)))
+        self.maybe_summarize()
+
+    def render(self, budget=None) -> str:
+        """Summary plus the newest turns that fit into the budget (in tokens)"""
+        budget = budget or self.budget
+        with self.lock:
+            summary = f'Summary of the earlier conversation: {self.summary}\n' if self.summary else ''
+            used = estimate_tokens(summary) if summary else 0
+            if used > budget:
+                summary, used = '', 0
+            lines = []
+            for line, tokens in reversed(self.turns):
+                if used + tokens > budget:
+                    break
+                lines.append(line)
+                used += tokens
+        if summary:
+            lines.append(summary)
+        return ''.join(reversed(lines))
+
+    def maybe_summarize(self):
+        """Folds the turns that no longer fit into the budget into the summary, off the hot path"""
+        if not self.summarize:
+            return
+        with self.lock:
+            if self.summarizing:
+                return
+            pending = self.turns[:]
+            if sum(tokens for _, tokens in pending) <= self.budget:
+                return
+            # Keep half the budget verbatim, summarize the rest
+            kept = used = 0
+            for _, tokens in reversed(pending):
+                if used + tokens > self.budget // 2:
+                    break
+                used += tokens
+                kept += 1
+            count = len(pending) - kept
+            text = ''.join(line for line, _ in pending[:count])
+            summary = self.summary
+            self.summarizing = True
+
+        def run():
+            try:
+                new_summary = self.summarize(summary, text)
+            except Exception as e:
+                print(f'Summarizing history failed: {e}')
+                new_summary = None
+            with self.lock:
+                if new_summary:
+                    self.summary = new_summary.strip()
+                    # Only appends happen meanwhile, the oldest turns are the ones summarized
+                    del self.turns[:count]
+                    self.summarized += count
+                self.summarizing = False
+
+        if self.submit:
+            self.submit(run)
+        else:
+            threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,150 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Images sent along with a question.
+# Photos straight from a phone are several megabytes, Gemini scales them down anyway. Before an image
+# is sent, it is turned upright, scaled to at most IMAGE_MAX_SIDE pixels and re-encoded as JPEG
+# (IMAGE_QUALITY), unless the original is already smaller. The result is cached by the hash of the
+# uploaded bytes (IMAGE_CACHE_MB for all sessions), asking about the same image again costs nothing.
+# The metrics count the bytes uploaded, sent and saved (image_bytes_in / _sent / _saved) and time the
+# preprocessing (image_preprocess); answers about images are timed as generation_image.
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from util import metrics
+from util.settings import IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_CACHE_MB, IMAGE_MAX_MB
+
+# Formats Gemini accepts as they are
+MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+# File types the chat input accepts
+FILE_TYPES = ['jpg', 'jpeg', 'png', 'webp', 'gif', 'bmp', 'tiff']
+THUMBNAIL_SIDE = 320
+
+
+class ImageError(ValueError):
+    """The upload is not an image we can use, the message can be shown to the user"""
+    friendly = True
+
+
+def _open(data: bytes):
+    from PIL import Image, ImageOps
+    if len(data) > IMAGE_MAX_MB * 1024 * 1024:
+        raise ImageError(f'This image is too large, please send one of less than {IMAGE_MAX_MB} MB.')
+    try:
+        image = Image.open(io.BytesIO(data))
+        original_format = image.format
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        raise ImageError("Sorry, I can't read this image. Please send a JPEG, PNG or WebP picture.")
+    return image, original_format
+
+def _jpeg(image, max_side, quality) -> bytes:
+    from PIL import Image
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode != 'RGB':
+        # JPEG has no transparency, transparent parts become white
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, 'white')
+        image.paste(rgba, mask=rgba.getchannel('A'))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+def preprocess(data: bytes, max_side=IMAGE_MAX_SIDE, quality=IMAGE_QUALITY):
+    """Scales and re-encodes an uploaded image.
+
+    Returns:
+        tuple: (bytes, mime type) - the original if it is already small enough and in a format Gemini takes
+    """
+    image, original_format = _open(data)
+    small = max(image.size) <= max_side
+    encoded = _jpeg(image, max_side, quality)
+    if small and original_format in MIME_TYPES and len(data) <= len(encoded):
+        return data, MIME_TYPES[original_format]
+    return encoded, 'image/jpeg'
+
+def thumbnail(data: bytes) -> bytes:
+    """Small JPEG of an image for the chat transcript"""
+    image, _ = _open(data)
+    return _jpeg(image, THUMBNAIL_SIDE, 75)
+
+
+class ImageCache:
+    """Thread safe LRU cache of preprocessed images by the hash of the uploaded bytes, bounded by bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # hash -> (bytes, mime type)
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.bytes += len(entry[0])
+            while self.bytes > self.max_bytes and self.entries:
+                _, (data, _) = self.entries.popitem(last=False)
+                self.bytes -= len(data)
+
+
+# One image cache per process, shared by all sessions. Nothing is allocated before the first image.
+_cache = ImageCache(IMAGE_CACHE_MB * 1024 * 1024)
+metrics.gauge('image_cache_bytes', lambda: _cache.bytes)
+
+def prepare_image(data: bytes):
+    """The image to send for uploaded bytes, preprocessed or from the cache.
+
+    Returns:
+        tuple: (bytes, mime type)
+    """
+    key = _cache.key(data)
+    entry = _cache.get(key)
+    if entry is None:
+        metrics.event('image_cache_miss')
+        with metrics.span('image_preprocess'):
+            entry = preprocess(data)
+        _cache.put(key, entry)
+    else:
+        metrics.event('image_cache_hit')
+    metrics.event('image_bytes_in', len(data))
+    metrics.event('image_bytes_sent', len(entry[0]))
+    metrics.event('image_bytes_saved', len(data) - len(entry[0]))
+    return entry
+
+
+if __name__ == '__main__':
+    # python -m util.images <file>... - what preprocessing does to them
+    import sys
+    import time
+    for name in sys.argv[1:]:
+        with open(name, 'rb') as f:
+            data = f.read()
+        start = time.perf_counter()
+        processed, mime_type = preprocess(data)
+        print(f'{name}: {len(data)} -> {len(processed)} bytes ({mime_type}) in {(time.perf_counter() - start) * 1000:.0f} ms')
@@ -0,0 +1,174 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local fast path for intent detection.
+# A lexicon of Alphabet names catches the obvious cases, a small naive Bayes model
+# trained from logged LLM decisions (INTENT_LOG, off by default) catches the rest. When neither is confident
+# we return None and the caller asks the LLM (get_intent in main.py).
+#
+# Usage:
+#   INTENT_LOG=intent_log.jsonl python -m util.intent train    train the model from the decision log
+#   INTENT_LOG=intent_log.jsonl python -m util.intent report   hit rate and accuracy per confidence threshold
+
+import json
+import math
+import os
+import re
+import sys
+from functools import lru_cache
+
+# Data collection switch: with INTENT_LOG set to a file name, every query that goes to the LLM
+# classifier is appended to it together with the decision, to train the local model from.
+# Off by default, the file holds raw user queries.
+INTENT_LOG = os.getenv("INTENT_LOG", "")
+INTENT_MODEL = os.getenv("INTENT_MODEL", "intent_model.json")
+INTENT_THRESHOLD = float(os.getenv("INTENT_THRESHOLD", "0.95"))
+
+# Alphabet, its subsidiaries (bets) and their best known products
+# (only names that are unambiguous, 'wing' or 'nest' alone could be about anything)
+lexicon = {'youtube', 'waymo', 'verily', 'deepmind', 'isomorphic labs', 'capitalg',
+           'fitbit', 'gmail', 'sundar', 'pichai', 'ruth porat', 'larry page', 'sergey brin',
+           'other bets', '10-k'}
+# Names that are just as often about something else ("the English alphabet", "google the weather",
+# "how to write an annual report"). They only decide together with a word about the company.
+ambiguous = {'alphabet', 'alphabet\'s', 'google', 'google\'s', 'android', 'annual report'}
+company_words = {'company', 'business', 'revenue', 'revenues', 'profit', 'earnings', 'income', 'stock', 'shares',
+                 'shareholders', 'ceo', 'cfo', 'subsidiary', 'subsidiaries', 'bets', 'acquisition', 'acquisitions',
+                 'employees', 'headquarters', 'founded', 'founders', 'investments', 'segment', 'segments', 'fiscal'}
+# Words that point back into the conversation. Without a lexicon hit we can't tell locally what they mean.
+followups = {'it', 'its', 'they', 'their', 'them', 'that', 'this', 'those', 'these', 'he', 'she', 'his', 'her',
+             'more', 'else', 'why', 'also'}
+
+_word = re.compile(r"[a-z0-9][a-z0-9\-']*")
+
+def tokenize(text: str):
+    words = _word.findall(text.lower())
+    return words + [a + ' ' + b for a, b in zip(words, words[1:])]
+
+def lexicon_hit(tokens) -> bool:
+    """An unambiguous name, or an ambiguous one together with a word about the company"""
+    return any(t in lexicon for t in tokens) or \
+        (any(t in ambiguous for t in tokens) and any(t in company_words for t in tokens))
+
+
+def train(records):
+    """Trains a multinomial naive Bayes model from [{'query': str, 'intent': str}]"""
+    counts = {'alphabet': {}, 'other': {}}
+    docs = {'alphabet': 0, 'other': 0}
+    for record in records:
+        label = 'alphabet' if record['intent'] == 'alphabet' else 'other'
+        docs[label] += 1
+        for token in set(tokenize(record['query'])):
+            counts[label][token] = counts[label].get(token, 0) + 1
+    return {'counts': counts, 'docs': docs}
+
+def probability(model, tokens) -> float:
+    """Probability of 'alphabet' for the tokens"""
+    docs = model['docs']
+    if not docs['alphabet'] or not docs['other']:
+        return 0.5
+    score = math.log(docs['alphabet'] / docs['other'])
+    a, o = model['counts']['alphabet'], model['counts']['other']
+    for token in set(tokens):
+        if token in a or token in o:
+            score += math.log((a.get(token, 0) + 1) / (docs['alphabet'] + 2))
+            score -= math.log((o.get(token, 0) + 1) / (docs['other'] + 2))
+    score = max(min(score, 50), -50)
+    return 1 / (1 + math.exp(-score))
+
+@lru_cache(maxsize=1)
+def load_model(path=INTENT_MODEL):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def classify(query: str, history: str = '', model=None, threshold: float = INTENT_THRESHOLD):
+    """Classifies the intent locally.
+
+    Args:
+        query (str): Latest query from user
+        history (str): Conversation history, only used to decide if a follow-up question can be judged locally
+        model (dict): Naive Bayes model, defaults to the one in INTENT_MODEL
+        threshold (float): Minimum confidence for a local decision
+
+    Returns:
+        dict: {'intent': 'alphabet' | 'other'} or None if the LLM should decide
+    """
+    tokens = tokenize(query)
+    if lexicon_hit(tokens):
+        return {'intent': 'alphabet'}
+    if history and any(t in followups for t in tokens):
+        return None
+    model = model if model is not None else load_model()
+    if not model:
+        return None
+    p = probability(model, tokens)
+    if p >= threshold:
+        return {'intent': 'alphabet'}
+    if 1 - p >= threshold:
+        return {'intent': 'other'}
+    return None
+
+def log_decision(query: str, intent: dict, path=INTENT_LOG):
+    """Logs a decision of the LLM so that we can train the local model from it"""
+    if not path:
+        return
+    try:
+        with open(path, 'a') as f:
+            f.write(json.dumps({'query': query, 'intent': intent.get('intent', 'other')}) + '\n')
+    except OSError as e:
+        print(f'Could not log intent decision: {e}')
+
+
+def read_log(path=INTENT_LOG):
+    if not path:
+        print('Set INTENT_LOG to the decision log')
+        exit(1)
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def report(records, thresholds=(0.8, 0.9, 0.95, 0.99, 0.999)):
+    """Hit rate (share decided locally) and accuracy of the local decisions per threshold.
+    Every fifth record is held out for testing, the model is trained on the rest."""
+    train_set = [r for i, r in enumerate(records) if i % 5]
+    test_set = [r for i, r in enumerate(records) if not i % 5]
+    model = train(train_set)
+    rows = []
+    for threshold in thresholds:
+        hits = correct = 0
+        for record in test_set:
+            intent = classify(record['query'], model=model, threshold=threshold)
+            if intent:
+                hits += 1
+                correct += intent['intent'] == record['intent']
+        rows.append({'threshold': threshold, 'tested': len(test_set),
+                     'hit_rate': hits / len(test_set) if test_set else 0.0,
+                     'accuracy': correct / hits if hits else 0.0})
+    return rows
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'report'
+    records = read_log()
+    if command == 'train':
+        with open(INTENT_MODEL, 'w') as f:
+            json.dump(train(records), f)
+        print(f'Trained {INTENT_MODEL} from {len(records)} decisions')
+    else:
+        print(f"{'threshold':>10} {'tested':>8} {'hit rate':>9} {'accuracy':>9}")
+        for row in report(records):
+            print(f"{row['threshold']:>10} {row['tested']:>8} {row['hit_rate']:>9.1%} {row['accuracy']:>9.1%}")
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 
+import threading
+from functools import wraps
 from vertexai.preview.generative_models import GenerativeModel
 from google.cloud import aiplatform
 from util.settings import PROJECT, REGION
@@ -21,6 +23,38 @@ from util.settings import PROJECT, REGION
 # load all LLMs in a central place, only once.
 # These operations take time and memory and doing this in a
 # central module saves both.
+# Nothing is created on import: the first caller of get_model() pays for it
+# (or warm_up in util/rag.py does it in the background at server start).
 
-aiplatform.init(project=PROJECT, location=REGION)
-modelg = GenerativeModel("gemini-1.5-flash-001")
+def singleton(factory):
+    """Turns a factory function into a thread safe getter that creates the object on first use, once per process"""
+    instance = []
+    lock = threading.Lock()
+
+    @wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+    def set(value):
+        # Replaces the object, e.g. with a local fake for benchmarks
+        with lock:
+            instance[:] = [value]
+    get.loaded = lambda: bool(instance)
+    get.set = set
+    return get
+
+MODEL = "gemini-1.5-flash-001"
+
+@singleton
+def get_model():
+    aiplatform.init(project=PROJECT, location=REGION)
+    return GenerativeModel(MODEL)
+
+def __getattr__(name):
+    # util.llm.modelg still works, but is created lazily
+    if name == 'modelg':
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
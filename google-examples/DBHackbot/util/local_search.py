@@ -0,0 +1,164 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local retrieval over the PDFs in a directory, as an alternative to Vertex AI Search.
+# Every page is a chunk. The index has two parts, both stored as .npy files and
+# memory mapped when loaded:
+#   - BM25 postings (term -> chunks and term frequencies)
+#   - a hashed bag-of-words embedding per chunk (no model needed, works offline)
+# A search scores all chunks with both and combines the scores.
+#
+# Usage:
+#   python -m util.local_search build [docdir]    build the index (default: sampledoc)
+#   python -m util.local_search search <query>    try it out
+
+import json
+import os
+import re
+import sys
+import time
+import zlib
+import numpy as np
+
+LOCAL_INDEX = os.getenv("LOCAL_INDEX", "local_index")
+EMBEDDING_DIM = 512
+K1 = 1.5
+B = 0.75
+VECTOR_WEIGHT = 0.3
+
+_word = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str):
+    return _word.findall(text.lower())
+
+def embed(tokens, dim=EMBEDDING_DIM):
+    """Hashed bag of words (unigrams and bigrams), L2 normalized"""
+    vector = np.zeros(dim, dtype=np.float32)
+    features = tokens + [a + ' ' + b for a, b in zip(tokens, tokens[1:])]
+    if not features:
+        return vector
+    hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, hashes % dim, signs)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def read_pages(docdir):
+    """Yields (file name, page number, text) for every page of every pdf in docdir"""
+    from pypdf import PdfReader
+    for name in sorted(os.listdir(docdir)):
+        if not name.lower().endswith('.pdf'):
+            continue
+        reader = PdfReader(os.path.join(docdir, name))
+        for number, page in enumerate(reader.pages, start=1):
+            text = page.extract_text() or ''
+            if text.strip():
+                yield name, number, text
+
+def build(docdir, index_dir=LOCAL_INDEX):
+    """Builds the index for all pdfs in docdir"""
+    chunks = []
+    vocabulary = {}
+    postings = []   # per term: {chunk: term frequency}
+    lengths = []
+    embeddings = []
+    for name, page, text in read_pages(docdir):
+        chunk = len(chunks)
+        chunks.append({'file': name, 'page': page, 'text': ' '.join(text.split())})
+        tokens = tokenize(text)
+        lengths.append(len(tokens))
+        embeddings.append(embed(tokens))
+        for token in tokens:
+            term = vocabulary.setdefault(token, len(vocabulary))
+            if term == len(postings):
+                postings.append({})
+            postings[term][chunk] = postings[term].get(chunk, 0) + 1
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p) for p in postings])
+    docs = np.fromiter((c for p in postings for c in p), dtype=np.int32, count=int(offsets[-1]))
+    tfs = np.fromiter((tf for p in postings for tf in p.values()), dtype=np.float32, count=int(offsets[-1]))
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(index_dir, 'docs.npy'), docs)
+    np.save(os.path.join(index_dir, 'tfs.npy'), tfs)
+    np.save(os.path.join(index_dir, 'lengths.npy'), np.array(lengths, dtype=np.float32))
+    np.save(os.path.join(index_dir, 'embeddings.npy'), np.array(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM))
+    with open(os.path.join(index_dir, 'vocabulary.json'), 'w') as f:
+        json.dump(vocabulary, f)
+    with open(os.path.join(index_dir, 'chunks.jsonl'), 'w') as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk) + '\n')
+    return len(chunks)
+
+
+class LocalIndex:
+
+    def __init__(self, index_dir=LOCAL_INDEX):
+        load = lambda name: np.load(os.path.join(index_dir, name), mmap_mode='r')
+        self.offsets = load('offsets.npy')
+        self.docs = load('docs.npy')
+        self.tfs = load('tfs.npy')
+        self.lengths = load('lengths.npy')
+        self.embeddings = load('embeddings.npy')
+        with open(os.path.join(index_dir, 'vocabulary.json')) as f:
+            self.vocabulary = json.load(f)
+        with open(os.path.join(index_dir, 'chunks.jsonl')) as f:
+            self.chunks = [json.loads(line) for line in f]
+        self.average_length = float(np.mean(self.lengths)) if len(self.lengths) else 0.0
+
+    def bm25(self, tokens):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        n = len(self.chunks)
+        for term in set(tokens):
+            t = self.vocabulary.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end]
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = K1 * (1 - B + B * self.lengths[docs] / self.average_length)
+            scores[docs] += idf * tfs * (K1 + 1) / (tfs + norm)
+        return scores
+
+    def search(self, query: str, k=5):
+        """Returns the top k chunks as [(score, chunk dict)]"""
+        if not self.chunks:
+            return []
+        tokens = tokenize(query)
+        scores = self.bm25(tokens)
+        if scores.max() > 0:
+            scores /= scores.max()
+        scores += VECTOR_WEIGHT * (self.embeddings @ embed(tokens))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.chunks[i]) for i in top]
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if command == 'build':
+        docdir = sys.argv[2] if len(sys.argv) > 2 else 'sampledoc'
+        start = time.perf_counter()
+        count = build(docdir)
+        print(f'Indexed {count} pages from {docdir} into {LOCAL_INDEX} in {time.perf_counter() - start:.1f}s')
+    else:
+        index = LocalIndex()
+        start = time.perf_counter()
+        results = index.search(' '.join(sys.argv[2:]))
+        print(f'{(time.perf_counter() - start) * 1000:.2f} ms')
+        for score, chunk in results:
+            print(f"{score:.3f} {chunk['file']} p.{chunk['page']}: {chunk['text'][:100]}")
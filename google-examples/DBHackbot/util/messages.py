@@ -0,0 +1,208 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Chat transcripts of the sessions.
+# Messages are small __slots__ records with interned roles. Every message is written to an
+# append-only SQLite log when it is added. A session keeps only its newest messages in memory,
+# up to SESSION_MEMORY_KB; older ones are read back from the log a page at a time when somebody
+# scrolls up, by message id, so messages deleted or added meanwhile don't shift the pages.
+# The log also lets a session pick up its transcript again after a restart.
+# Without a log (SESSION_STORE='', the default), the messages over SESSION_MEMORY_KB are dropped.
+# Logged messages are deleted after SESSION_RETENTION_DAYS.
+# python -m util.messages report prints what the log holds per session, python -m util.messages expire
+# deletes the old messages right away.
+
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from itertools import islice
+from util import metrics
+from util.settings import SESSION_STORE, SESSION_MEMORY_KB, SESSION_SECRET, SESSION_RETENTION_DAYS
+
+
+class Message:
+    """A chat message: role ('user' or 'chatbot'), text and optional content for st.write (not logged).
+    id is the number of the message in the log, None if it isn't logged."""
+    __slots__ = ('role', 'text', 'content', 'id', '__weakref__')
+
+    def __init__(self, role, text='', content=None, id=None):
+        self.role = sys.intern(role)
+        self.text = text or ''
+        self.content = content
+        self.id = id
+
+    def size(self) -> int:
+        """Bytes in memory, the role is shared"""
+        return sys.getsizeof(self) + sys.getsizeof(self.text) + (len(self.content) if isinstance(self.content, bytes) else 0)
+
+
+class MessageLog:
+    """Append-only log of the messages of all sessions in a SQLite file, shared by the sessions of a process.
+    Several processes (and tabs of the same session) may write to it, SQLite numbers the messages."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS transcripts (id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, role TEXT, text TEXT, time REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS transcripts_session ON transcripts (session, id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS transcripts_time ON transcripts (time)')
+        self.lock = threading.Lock()
+        self.expiring = False
+
+    def append(self, session, message: Message) -> int:
+        """Logs a message, returns its id"""
+        with self.lock:
+            return self.db.execute('INSERT INTO transcripts (session, role, text, time) VALUES (?, ?, ?, ?)',
+                                   (session, message.role, message.text, time.time())).lastrowid
+
+    def count(self, session) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM transcripts WHERE session = ?', (session,)).fetchone()[0]
+
+    def read(self, session, before=None, limit=-1) -> list:
+        """The newest limit messages of the session (all with -1) with an id below before, oldest first"""
+        with self.lock:
+            rows = self.db.execute('SELECT id, role, text FROM transcripts WHERE session = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                                   (session, sys.maxsize if before is None else before, limit)).fetchall()
+        return [Message(role, text, id=id) for id, role, text in reversed(rows)]
+
+    def expire(self, days) -> int:
+        """Deletes the messages older than days, returns how many"""
+        with self.lock:
+            return self.db.execute('DELETE FROM transcripts WHERE time < ?', (time.time() - days * 86400,)).rowcount
+
+    def start_expiry(self, days, interval=3600):
+        """Deletes old messages now and every interval seconds, in a background thread"""
+        if days <= 0 or self.expiring:
+            return
+        self.expiring = True
+        def run():
+            while True:
+                try:
+                    self.expire(days)
+                except Exception as e:
+                    print(f'Deleting old chat messages failed: {e}')
+                time.sleep(interval)
+        threading.Thread(target=run, daemon=True, name='transcript-expiry').start()
+
+    def report(self) -> list:
+        """(session, messages, bytes of text) for every session in the log"""
+        with self.lock:
+            return self.db.execute('SELECT session, COUNT(*), SUM(LENGTH(text)) FROM transcripts GROUP BY session ORDER BY 3 DESC').fetchall()
+
+
+# Session ids come from the url, so they are signed: nobody can read a transcript by guessing or
+# changing an id. Without SESSION_SECRET the key is made up per process, links then stop working on restart.
+_secret = (SESSION_SECRET or secrets.token_hex(32)).encode()
+
+def sign_session(session) -> str:
+    """Session id with its signature, for the url"""
+    return f'{session}.{hmac.new(_secret, session.encode(), hashlib.sha256).hexdigest()[:32]}'
+
+def verify_session(signed):
+    """The session id of a signed id from the url, None if the signature doesn't match"""
+    session = (signed or '').rpartition('.')[0]
+    if session and hmac.compare_digest(signed, sign_session(session)):
+        return session
+    return None
+
+
+_stores = weakref.WeakSet()
+
+
+class MessageStore:
+    """The transcript of a session.
+
+    Args:
+        session (str): Id of the session in the log
+        log (MessageLog): Where all messages go, None keeps them in memory only
+        cap (int): Bytes of messages kept in memory, the newest message always stays. Without a log older messages are dropped.
+    """
+
+    def __init__(self, session, log=None, cap=SESSION_MEMORY_KB * 1024):
+        self.session = session
+        self.log = log
+        self.cap = cap
+        self.count = log.count(session) if log else 0
+        self.first = self.count     # index of the oldest message in memory
+        self.recent = deque()
+        self.bytes = 0
+        _stores.add(self)
+
+    def append(self, role, text='', content=None) -> Message:
+        message = Message(role, text, content)
+        if self.log:
+            message.id = self.log.append(self.session, message)
+        self.recent.append(message)
+        self.count += 1
+        self.bytes += message.size()
+        # Messages over the cap are only in the log from now on, or gone if there is none
+        while self.bytes > self.cap and len(self.recent) > 1:
+            self.bytes -= self.recent.popleft().size()
+            if self.log:
+                self.first += 1
+            else:
+                self.count -= 1
+        return message
+
+    def __len__(self):
+        return self.count
+
+    def page(self, start, end=None) -> list:
+        """Messages start to end (exclusive), read from the log if they are no longer in memory"""
+        end = self.count if end is None else min(end, self.count)
+        start = max(0, start)
+        older = []
+        if self.log and start < self.first:
+            # The messages right before the oldest one in memory, counted back from it
+            before = self.recent[0].id if self.recent else None
+            older = self.log.read(self.session, before, self.first - start)[:max(0, min(end, self.first) - start)]
+        newer = list(islice(self.recent, max(0, start - self.first), max(0, end - self.first)))
+        return older + newer
+
+    def __iter__(self):
+        return iter(self.page(0))
+
+
+def report() -> dict:
+    """Memory used by the transcripts of the sessions in this process"""
+    stores = list(_stores)
+    memory = sum(store.bytes for store in stores)
+    return {'sessions': len(stores), 'messages': sum(store.count for store in stores),
+            'messages_in_memory': sum(len(store.recent) for store in stores),
+            'bytes_in_memory': memory, 'bytes_per_session': memory // len(stores) if stores else 0}
+
+metrics.gauge('sessions', lambda: len(_stores))
+metrics.gauge('session_memory_bytes', lambda: report()['bytes_in_memory'])
+
+
+if __name__ == '__main__':
+    # python -m util.messages report|expire
+    if len(sys.argv) < 2 or sys.argv[1] not in ('report', 'expire') or not SESSION_STORE:
+        print('Usage: python -m util.messages report|expire (with SESSION_STORE set)')
+        exit(1)
+    log = MessageLog(SESSION_STORE)
+    if sys.argv[1] == 'expire':
+        print(f'{log.expire(SESSION_RETENTION_DAYS)} messages older than {SESSION_RETENTION_DAYS} days deleted')
+        exit(0)
+    sessions = log.report()
+    print(f'{len(sessions)} sessions, {sum(s[1] for s in sessions)} messages, {sum(s[2] or 0 for s in sessions)} bytes of text')
+    for session, count, size in sessions[:20]:
+        print(f'{session:40} {count:6} messages {size or 0:10} bytes')
@@ -0,0 +1,216 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Latency tracing and metrics for the chat turns.
+# Every stage of a turn (intent, retrieval, generation, rendering, ...) runs in a span.
+# Spans feed process wide histograms and counters, which are exported in the Prometheus
+# text format, and the turn they belong to. When a turn ends, it is printed as one JSON
+# line, which Cloud Logging picks up as a structured log entry.
+# The current turn is kept in a context variable; work handed to other threads has to be
+# wrapped with bind() to stay part of the turn (and within its deadline, see util/calls.py).
+# With TRACING=false, span() returns a shared no-op and nothing is recorded.
+
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from util.settings import TRACING
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_histograms = {}   # stage -> [count per bucket..., +Inf count, sum]
+_counters = {}     # (metric, labels) -> value
+_gauges = {}       # name -> function returning the current value
+_current = contextvars.ContextVar('turn', default=None)
+_NOOP = contextlib.nullcontext()
+
+
+class Turn:
+    """Everything recorded during one chat turn"""
+    __slots__ = ('start', 'stages', 'tokens', 'events', 'errors', 'done')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.events = {}
+        self.errors = []
+        self.done = False
+
+    def as_dict(self):
+        return {'event': 'turn', 'seconds': round(time.perf_counter() - self.start, 4),
+                'stages': {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+                'tokens': self.tokens, 'events': self.events, 'errors': self.errors}
+
+
+def start_turn():
+    """Starts a turn in the current context, returns it (None if tracing is off)"""
+    if not TRACING:
+        return None
+    turn = Turn()
+    _current.set(turn)
+    return turn
+
+def end_turn(turn):
+    """Ends the turn and logs it. Spans still running (e.g. a dropped speculative answer) are not added any more."""
+    if turn is None or turn.done:
+        return
+    turn.done = True
+    observe('turn', time.perf_counter() - turn.start)
+    print(json.dumps(turn.as_dict()), flush=True)
+
+def _turn():
+    turn = _current.get()
+    return turn if turn is not None and not turn.done else None
+
+def bind(function):
+    """Wraps function to run in a copy of the current context, so threads keep adding to the current turn
+    and keep its deadline. Copying the context is cheap, so this is done with tracing off as well."""
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+class _Span:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.stage, time.perf_counter() - self.start)
+        if exc_type is not None:
+            error(self.stage, exc)
+        return False
+
+def span(stage):
+    """Context manager measuring a stage: with span('retrieval'): ..."""
+    return _Span(stage) if TRACING else _NOOP
+
+def observe(stage, seconds):
+    """Records the duration of a stage, also for stages that can't be wrapped in a span (e.g. streams)"""
+    if not TRACING:
+        return
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(BUCKETS)] += 1
+        histogram[-1] += seconds
+    if turn := _turn():
+        turn.stages[stage] = turn.stages.get(stage, 0.0) + seconds
+
+def _count(metric, labels, value=1):
+    with _lock:
+        _counters[(metric, labels)] = _counters.get((metric, labels), 0) + value
+
+def event(name, count=1):
+    """Counts an event, e.g. a cache hit"""
+    if not TRACING:
+        return
+    _count('events_total', (('event', name),), count)
+    if turn := _turn():
+        turn.events[name] = turn.events.get(name, 0) + count
+
+def error(stage, exception=None):
+    """Counts an error in a stage"""
+    if not TRACING:
+        return
+    _count('errors_total', (('stage', stage),))
+    if turn := _turn():
+        turn.errors.append({'stage': stage, 'error': str(exception)[:200]} if exception else {'stage': stage})
+
+def tokens(stage, kind, count):
+    """Counts tokens of a stage, kind is e.g. prompt, output or prefix"""
+    if not TRACING or not count:
+        return
+    _count('tokens_total', (('stage', stage), ('kind', kind)), count)
+    if turn := _turn():
+        key = f'{stage}_{kind}'
+        turn.tokens[key] = turn.tokens.get(key, 0) + count
+
+def usage(stage, response):
+    """Counts the tokens of a model response from its usage_metadata"""
+    if not TRACING:
+        return
+    metadata = getattr(response, 'usage_metadata', None)
+    if metadata is None:
+        return
+    for kind, field in (('prompt', 'prompt_token_count'), ('output', 'candidates_token_count'), ('cached', 'cached_content_token_count')):
+        tokens(stage, kind, getattr(metadata, field, 0) or 0)
+
+
+def gauge(name, function):
+    """Registers a gauge, function is called for its current value whenever the metrics are exported"""
+    _gauges[name] = function
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+def prometheus() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = ['# TYPE dbhackbot_stage_seconds histogram']
+    with _lock:
+        histograms = {stage: list(values) for stage, values in _histograms.items()}
+        counters = dict(_counters)
+    for stage, values in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values):
+            cumulative += count
+            lines.append(f'dbhackbot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'dbhackbot_stage_seconds_sum{{stage="{stage}"}} {values[-1]}')
+        lines.append(f'dbhackbot_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+    metrics = sorted({metric for metric, _ in counters})
+    for metric in metrics:
+        lines.append(f'# TYPE dbhackbot_{metric} counter')
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric:
+                lines.append(f'dbhackbot_{metric}{{{_labels(labels)}}} {value}')
+    for name, function in sorted(_gauges.items()):
+        lines.append(f'# TYPE dbhackbot_{name} gauge')
+        lines.append(f'dbhackbot_{name} {function()}')
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        found = self.path == '/metrics'
+        body = prometheus().encode() if found else b''
+        self.send_response(200 if found else 404)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host='0.0.0.0'):
+    """Starts the /metrics exporter in a background thread"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Metrics on http://{host}:{port}/metrics')
+    return server
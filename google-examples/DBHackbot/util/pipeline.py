@@ -0,0 +1,207 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A small pipeline runner for create_searchapp.py.
+# Stages run as soon as the stages they depend on are finished, independent stages run
+# at the same time. A stage may return a long running operation, which is then polled
+# with backoff until it is done. The state (finished stages and their results, names of
+# operations in flight) is written to a file, so after an interruption a rerun skips
+# what is finished and keeps polling the operations instead of starting them again.
+# An operation that failed is not picked up again, the next run starts the stage anew.
+# The state file is removed after a successful run.
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+
+    def __init__(self, name, run, depends=(), on_done=None, response_type=None):
+        """
+        Args:
+            name (str): Name of the stage
+            run (callable): run(results) with the results of all finished stages by name.
+                Returns a JSON serializable result or a long running operation.
+            depends (tuple[str]): Stages that must be finished first
+            on_done (callable): on_done(operation result) for stages returning an operation,
+                returns the (JSON serializable) result of the stage
+            response_type: Message type of the operation result (e.g. discoveryengine.ImportDocumentsResponse),
+                needed to get the result of an operation picked up from an earlier run
+        """
+        self.name = name
+        self.run = run
+        self.depends = tuple(depends)
+        self.on_done = on_done
+        self.response_type = response_type
+
+
+def operation_name(operation):
+    """Name of a google.api_core Operation, None for anything else"""
+    return getattr(getattr(operation, 'operation', None), 'name', None)
+
+
+class ResumedOperation:
+    """An operation started by an earlier run, polled by name through get_operation(name).
+    get_operation returns a google.longrunning Operation proto (or anything with .done, .error and .response).
+    The result is the response unpacked into response_type, None without a response_type."""
+
+    def __init__(self, name, get_operation, response_type=None):
+        self.name = name
+        self.get_operation = get_operation
+        self.response_type = response_type
+        self.current = None
+
+    def done(self):
+        self.current = self.get_operation(self.name)
+        return self.current.done
+
+    def result(self):
+        error = getattr(self.current, 'error', None)
+        if error is not None and getattr(error, 'code', 0):
+            raise RuntimeError(f'Operation {self.name} failed: {error.message}')
+        if self.response_type is None:
+            return None
+        return self.response_type.deserialize(self.current.response.value)
+
+
+class Pipeline:
+
+    def __init__(self, stages, state_file='.setup_state.json', get_operation=None,
+                 poll_start=2.0, poll_max=30.0, timeout=3 * 3600, workers=8):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = state_file
+        self.get_operation = get_operation
+        self.poll_start = poll_start
+        self.poll_max = poll_max
+        self.timeout = timeout
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.state = self.load_state()
+        self.timings = {}
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            print(f'Resuming setup from {self.state_file}')
+            return state
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, name, **entry):
+        with self.lock:
+            self.state[name] = entry
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.replace(self.state_file + '.tmp', self.state_file)
+
+    def results(self):
+        with self.lock:
+            return {name: entry.get('result') for name, entry in self.state.items() if entry.get('status') == 'done'}
+
+    def poll(self, stage, operation, start):
+        """Waits for an operation with exponential backoff, reports progress. Returns when it is done, raises TimeoutError if it takes too long."""
+        delay = self.poll_start
+        while not operation.done():
+            elapsed = time.perf_counter() - start
+            if elapsed > self.timeout:
+                raise TimeoutError(f'{stage.name} still running after {elapsed:.0f}s')
+            print(f'[{stage.name}] running for {elapsed:.0f}s...')
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_max)
+
+    def run_stage(self, stage):
+        start = time.perf_counter()
+        entry = self.state.get(stage.name, {})
+        if entry.get('status') == 'running' and entry.get('operation') and self.get_operation:
+            print(f'[{stage.name}] picking up operation {entry["operation"]}')
+            result = ResumedOperation(entry['operation'], self.get_operation, stage.response_type)
+        else:
+            print(f'[{stage.name}] started')
+            result = stage.run(self.results())
+        if hasattr(result, 'done') and hasattr(result, 'result'):
+            name = operation_name(result) or getattr(result, 'name', None)
+            self.save_state(stage.name, status='running', operation=name)
+            # Still running after the timeout: the next run keeps polling
+            self.poll(stage, result, start)
+            try:
+                result = result.result()
+            except Exception:
+                # The operation failed, polling it again won't help: the next run starts a new one
+                self.save_state(stage.name, status='failed', operation=name)
+                raise
+            result = stage.on_done(result) if stage.on_done else None
+        self.save_state(stage.name, status='done', result=result)
+        self.timings[stage.name] = time.perf_counter() - start
+        print(f'[{stage.name}] finished in {self.timings[stage.name]:.1f}s')
+        return result
+
+    def run(self) -> bool:
+        """Runs all stages. Returns True if all of them succeeded."""
+        pending = dict(self.stages)
+        failed = set()
+        skipped = set()
+        running = {}
+        total = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(d in failed for d in stage.depends):
+                        print(f'[{name}] skipped because {", ".join(d for d in stage.depends if d in failed)} failed')
+                        failed.add(name)
+                        skipped.add(name)
+                        del pending[name]
+                    elif self.state.get(name, {}).get('status') == 'done':
+                        print(f'[{name}] already finished in an earlier run')
+                        self.timings[name] = 0.0
+                        del pending[name]
+                    elif all(self.state.get(d, {}).get('status') == 'done' for d in stage.depends):
+                        running[executor.submit(self.run_stage, stage)] = name
+                        del pending[name]
+                if not running:
+                    if pending:
+                        # Nothing can run anymore, a dependency is missing
+                        failed.update(pending)
+                        pending.clear()
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'[{name}] ERROR: {e}')
+                        failed.add(name)
+        self.summary(time.perf_counter() - total, failed, skipped)
+        if not failed and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return not failed
+
+    def summary(self, total, failed, skipped):
+        print()
+        print('Stage timings:')
+        for name in self.stages:
+            if name in skipped:
+                status = 'skipped'
+            elif name in failed:
+                status = 'failed'
+            elif name in self.timings:
+                status = f'{self.timings[name]:8.1f}s'
+            else:
+                status = 'not run'
+            print(f'  {name:<20} {status}')
+        print(f'  {"total":<20} {total:8.1f}s')
@@ -0,0 +1,107 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Precomputed answers for the prefab questions (PREFAB_QUESTIONS), the buttons on a fresh session.
+# They are computed in the background at server start and again every PREFAB_REFRESH seconds, a click
+# gets the stored answer right away. Until the first answer is there, all sessions asking the same
+# question wait for the one computation under way instead of starting their own (single flight).
+# During a refresh the previous answer is still handed out.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from util import metrics
+from util.cache import normalize, copy_response
+
+
+class PrefabAnswers:
+    """Answers for a fixed set of questions, kept up to date in the background.
+
+    Args:
+        questions (list[str]): The questions
+        answer (callable): answer(question) returns the complete response {'response', 'documents'}, raises if it failed
+        refresh (float): Seconds an answer is used before it is computed again
+    """
+
+    def __init__(self, questions, answer, refresh=3600):
+        self.questions = {normalize(question): question for question in questions}
+        self.answer = answer
+        self.refresh = refresh
+        self.answers = {}      # normalized question -> (response, time computed)
+        self.inflight = {}     # normalized question -> future of the computation under way
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefab')
+        self.started = False
+
+    def get(self, query, timeout=None):
+        """The answer if query is one of the questions, None otherwise (or if it can't be had within timeout)"""
+        key = normalize(query)
+        if key not in self.questions:
+            return None
+        with self.lock:
+            entry = self.answers.get(key)
+        if entry is not None:
+            if time.time() - entry[1] > self.refresh:
+                # Stale: served once more while the new answer is computed
+                self.compute(key)
+            metrics.event('prefab_hit')
+            return copy_response(entry[0])
+        try:
+            response = self.compute(key).result(timeout=timeout)
+        except Exception as e:
+            metrics.error('prefab', e)
+            return None
+        metrics.event('prefab_wait')
+        return copy_response(response)
+
+    def compute(self, key):
+        """Starts computing the answer of a question, unless that is under way already. Returns the future of the computation."""
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.inflight[key] = self.executor.submit(self._compute, key)
+            else:
+                metrics.event('prefab_joined')
+        return future
+
+    def _compute(self, key):
+        try:
+            with metrics.span('prefab'):
+                response = self.answer(self.questions[key])
+            with self.lock:
+                self.answers[key] = (response, time.time())
+            return response
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def refresh_all(self):
+        """Computes all answers again, one after the other"""
+        for key, question in self.questions.items():
+            try:
+                self.compute(key).result()
+            except Exception as e:
+                print(f'Precomputing the answer to "{question}" failed: {e}')
+
+    def start(self):
+        """Computes the answers now and then every refresh seconds, in a background thread. Only the first call counts."""
+        with self.lock:
+            if self.started or not self.questions:
+                return
+            self.started = True
+        def run():
+            while True:
+                self.refresh_all()
+                time.sleep(self.refresh)
+        threading.Thread(target=run, daemon=True, name='prefab-refresh').start()
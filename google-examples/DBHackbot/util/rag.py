@@ -12,18 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime
-from zoneinfo import ZoneInfo
 from google.cloud import discoveryengine_v1alpha as discoveryengine
 from google.api_core.client_options import ClientOptions
 from google.cloud import storage
 from google.cloud.storage.blob import Blob
-from util.llm import modelg
-from util.settings import PROJECT, LOCATION, engine_ds_name
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from util import metrics, prompts
+from util.cache import RetrievalCache
+from util.calls import call, call_stream
+from util.llm import get_model, singleton
+from util.reindex import manifest_name
+from util.settings import PROJECT, LOCATION, engine_ds_name, STREAMING, RETRIEVAL, REFERENCES
+from util.settings import RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, RETRIEVAL_CACHE_DB, RETRIEVAL_CACHE_CHECK
+from util.stream import stream_response, hydrate, when_hydrated
 from vertexai.generative_models import GenerationConfig, Tool
 from vertexai.preview.generative_models import grounding
 import ntpath
 import re
+import threading
+import time
 
 
 project = PROJECT
@@ -31,7 +39,13 @@ location = LOCATION
 datastore_project_id = project
 data_store_id = engine_ds_name
 serving_config_id = "default_search"
-storage_client = storage.Client()
+# create_searchapp.py uploads local documents here
+input_bucket_name = 'dbhackathon_input_' + project
+
+# Clients are created on first use, once per process
+@singleton
+def get_storage_client():
+    return storage.Client()
 
 #                                                                                EU requires specific API endpoint
 client_options = (ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com") if location != 'global' else None)
@@ -45,8 +59,11 @@ summary_spec = discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(
         )
 
 # Specific to summarization Search
-summary_search_client = discoveryengine.SearchServiceClient(client_options=client_options)
-summary_serving_config = summary_search_client.serving_config_path(project=datastore_project_id,
+@singleton
+def get_search_client():
+    return discoveryengine.SearchServiceClient(client_options=client_options)
+
+summary_serving_config = discoveryengine.SearchServiceClient.serving_config_path(project=datastore_project_id,
                                                                    location=location,
                                                                    data_store=data_store_id,
                                                                    serving_config=serving_config_id)
@@ -65,8 +82,9 @@ def list_parser(text: str):
     text = re.sub(r' ([0-9]+\. )', r'\n\1', text, 100)
     return text
 
+@lru_cache(maxsize=10000)
 def get_doc_url(uri):
-    """Transform the uri of the document into an url that can be accessed via browser
+    """Transform the uri of the document into an url that can be accessed via browser. Memoized per uri.
 
     Args:
         uri (str): uri of the document
@@ -74,10 +92,73 @@ def get_doc_url(uri):
     Returns:
         Browser accessible url of the document
     """
-    blob = Blob.from_string(uri, storage_client)
+    blob = Blob.from_string(uri, get_storage_client())
     url = blob.public_url
     return url.replace('googleapis', 'mtls.cloud.google')
 
+# References are built here in the background (REFERENCES=lazy), the answer doesn't wait for them
+@singleton
+def get_reference_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix='references')
+
+def references(response, build, items):
+    """Adds the documents built from items to the response: in the background (lazy) or right away (full)"""
+    if REFERENCES == 'lazy':
+        return hydrate(response, build, items, get_reference_executor().submit)
+    with metrics.span('documents'):
+        response['documents'] = [build(i, item) for i, item in enumerate(items, start=1)]
+    return response
+
+# Search results are cached across sessions (and with RETRIEVAL_CACHE_DB across processes)
+@singleton
+def get_retrieval_cache():
+    return RetrievalCache(max_size=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL, path=RETRIEVAL_CACHE_DB or None) if RETRIEVAL_CACHE_TTL > 0 else None
+
+_import_time = {'value': '', 'checked': 0.0, 'refreshing': False}
+_import_lock = threading.Lock()
+
+def import_generation():
+    """Time of the last import into the datastore, the update time of the manifest create_searchapp.py writes.
+    Looked up every RETRIEVAL_CACHE_CHECK seconds, cached search results from before it are ignored.
+    One caller does the lookup, the others get the value we have meanwhile."""
+    with _import_lock:
+        value = _import_time['value']
+        due = not _import_time['refreshing'] and time.monotonic() - _import_time['checked'] > RETRIEVAL_CACHE_CHECK
+        if not due:
+            return value
+        _import_time['refreshing'] = True
+    try:
+        blob = call('retrieval', get_storage_client().bucket(input_bucket_name).get_blob, manifest_name(engine_ds_name))
+        value = blob.updated.isoformat() if blob else ''
+    except Exception as e:
+        print(f'Checking the last import failed: {e}')
+    finally:
+        with _import_lock:
+            _import_time.update(value=value, checked=time.monotonic(), refreshing=False)
+    return value
+
+# Everything besides the query the summary search result depends on
+summary_page_size = 10
+summary_request_spec = (summary_serving_config, summary_page_size, content_search_spec, REFERENCES)
+
+def summary_document(i, result):
+    """Document for the references from a search result. Only the fields the sidebar shows, unless REFERENCES=full."""
+    struct_data = result.document.derived_struct_data
+    doc = {'name': f'[{i}] ' + ntpath.basename(struct_data['link']), 'url': get_doc_url(struct_data['link']), 'snippets': []}
+    snippets = struct_data.get('snippets', [])
+    if REFERENCES == 'lazy':
+        doc['snippets'] = [snippets[0]['snippet']] if snippets else []
+        return doc
+    doc['extracts'] = []
+    doc['segments'] = []
+    for snippet in snippets:
+        doc['snippets'].append(snippet['snippet'])
+    for extract in struct_data.get('extractive_answers', []):
+        doc['extracts'].append({'pageNumber': extract.get('pageNumber'), 'extract': extract.get('content')})
+    for extract in struct_data.get('extractive_segments', []):
+        doc['segments'].append({'pageNumber': extract.get('pageNumber'), 'extract': extract.get('content'), 'relevanceScore': extract.get('relevanceScore')})
+    return doc
+
 def search_engine_summary(query):
     """Executes the summary search algorithm by calling Vertex AI Search with summarization. Returns a summary of the result plus a list of documents, snippets, extracts and segments.
     
@@ -87,10 +168,18 @@ def search_engine_summary(query):
     Returns:
         dict: {'response': (str) Answer text, 'documents': (list[dict]) List of documents}
     """
+    cache = get_retrieval_cache()
+    if cache:
+        key = cache.key(query, 'summary', *summary_request_spec)
+        generation = import_generation()
+        if response := cache.get(key, generation):
+            metrics.event('retrieval_cache_hit')
+            return response
+        metrics.event('retrieval_cache_miss')
     request = discoveryengine.SearchRequest(
         serving_config=summary_serving_config,
         query=query,
-        page_size=10,
+        page_size=summary_page_size,
         filter='',
         content_search_spec=content_search_spec,
         query_expansion_spec=discoveryengine.SearchRequest.QueryExpansionSpec(
@@ -100,41 +189,129 @@ def search_engine_summary(query):
             mode=discoveryengine.SearchRequest.SpellCorrectionSpec.Mode.AUTO
         )
     )
-    search_response = summary_search_client.search(request)
-    response = {'response': list_parser(search_response.summary.summary_text), 'documents': []}
-    for i, result in enumerate(search_response.results, 1):
-        struct_data = result.document.derived_struct_data
-        doc = {'name': f'[{i}] ' + ntpath.basename(struct_data['link']), 'url': get_doc_url(struct_data['link']), 'snippets': [], 'extracts': [], 'segments': []}
-        for snippet in struct_data.get('snippets', []):
-            doc['snippets'].append(snippet['snippet'])
-        for extract in struct_data.get('extractive_answers', []):
-            doc['extracts'].append({'pageNumber': extract.get('pageNumber'), 'extract': extract.get('content')})
-        for extract in struct_data.get('extractive_segments', []):
-            doc['segments'].append({'pageNumber': extract.get('pageNumber'), 'extract': extract.get('content'), 'relevanceScore': extract.get('relevanceScore')})
-        response['documents'].append(doc)
+    with metrics.span('retrieval'):
+        search_response = call('retrieval', get_search_client().search, request)
+    response = references({'response': list_parser(search_response.summary.summary_text)}, summary_document, search_response.results)
+    if cache:
+        when_hydrated(response, lambda response: cache.put(key, response, generation))
     return response
 
-def search_engine_grounding(history, query):
+# Grounding tool for Gemini, built once
+@singleton
+def get_grounding_tool():
+    return Tool.from_retrieval(grounding.Retrieval(grounding.VertexAISearch(datastore=f'projects/{project}/locations/{location}/collections/default_collection/dataStores/{engine_ds_name}')))
+
+def warm_up():
+    """Creates all clients and tools, so that the first user doesn't have to wait for them"""
+    for get in (get_model, get_storage_client, get_search_client, get_grounding_tool):
+        try:
+            get()
+        except Exception as e:
+            metrics.error('warm_up', e)
+            print(f'Warm up of {get.__name__} failed: {e}')
+    # Exact token counts of the prompt preambles for the metrics
+    for prompt in prompts.prompts:
+        try:
+            prompt.count_tokens()
+        except Exception as e:
+            print(f'Counting the tokens of the {prompt.name} prompt failed: {e}')
+
+def grounding_document(i, chunk):
+    """Document for the references from a grounding chunk"""
+    doc = {'name': f'[{i}] ' + chunk.retrieved_context.title, 'url': get_doc_url(chunk.retrieved_context.uri)}
+    if REFERENCES == 'full':
+        doc.update({'snippets': [], 'extracts': [], 'segments': []})
+    return doc
+
+def grounding_documents(response, candidate):
+    """Adds the documents from the grounding metadata of a candidate to the response"""
+    return references(response, grounding_document, candidate.grounding_metadata.grounding_chunks)
+
+def streamed_grounding_documents(chunks):
+    """Collects the documents once a grounded stream has ended. The grounding metadata comes with the last chunks."""
+    found = {'documents': []}
+    for chunk in chunks:
+        for candidate in chunk.candidates:
+            if candidate.grounding_metadata.grounding_chunks:
+                found = grounding_documents({}, candidate)
+            break
+    return found
+
+def search_engine_grounding(history, query, stream=STREAMING):
     """Executes the grounding search algorithm by calling an LLM with grounding enabled. Returns a summary of the result plus a list of documents. This algorithm does not return any snippets, extracts or segments.
     
     Args:
         query (str): Query from user
+        stream (bool): Stream the answer. The response then carries a 'stream' generator yielding the text as it arrives,
+            'response' and 'documents' are complete once the generator is exhausted.
 
     Returns:
         dict: {'response': (str) Answer text, 'documents': (list[dict]) List of documents}
     """
 
-    current_time = datetime.now(tz=ZoneInfo("Europe/Berlin"))
-    llm_prompt = f"Today is {current_time.strftime('%A, %B %-d %Y')}. The current time is {current_time.strftime('%-H:%M')}.\n"\
-                "You are a cheerful chat companion. Your input are a chat history between a chatbot and a user. "\
-                "You are given the latest question from the user which you have to answer in a safe and joyful way.\n"\
-                "Provide answers that are suitable for any audience. Try to keep your responses to a few lines of text. For long answers, only mention the highlights.\n\n"\
-                f"Chat history:\n{history}\n"\
-                f"user: {query}\n"\
-                "chatbot: "
-    tool = Tool.from_retrieval(grounding.Retrieval(grounding.VertexAISearch(datastore=f'projects/{project}/locations/{location}/collections/default_collection/dataStores/{engine_ds_name}')))
-    llm_response = modelg.generate_content(llm_prompt, tools=[tool], generation_config=GenerationConfig(temperature=0.0))
+    model, contents = prompts.grounding.prepare(history, query)
+    tool = get_grounding_tool()
+    if stream:
+        response = {'response': '', 'documents': []}
+        chunks = call_stream('grounding', model.generate_content, contents, tools=[tool], generation_config=GenerationConfig(temperature=0.0), stream=True)
+        response['stream'] = stream_response(chunks, response, on_end=streamed_grounding_documents, stage='grounding')
+        return response
+    with metrics.span('grounding'):
+        llm_response = call('grounding', model.generate_content, contents, tools=[tool], generation_config=GenerationConfig(temperature=0.0))
+    metrics.usage('grounding', llm_response)
+    response = {'response': llm_response.text, 'documents': []}
     for candidate in llm_response.candidates:
-        docs = [{'name': f'[{i}] ' + c.retrieved_context.title, 'url': get_doc_url(c.retrieved_context.uri), 'snippets': [], 'extracts': [], 'segments': []} for i,c in enumerate(candidate.grounding_metadata.grounding_chunks, start=1)]
+        grounding_documents(response, candidate)
         break
-    return {'response': llm_response.text, 'documents': docs}
+    return response
+
+# Local retrieval (util/local_search.py), works without Vertex AI Search
+@singleton
+def get_local_index():
+    from util.local_search import LocalIndex
+    return LocalIndex()
+
+def local_document(i, chunk):
+    """Document for the references from a chunk of the local index, the url points to the page in the uploaded pdf"""
+    url = Blob.from_string(f"gs://{input_bucket_name}/{chunk['file']}").public_url.replace('googleapis', 'mtls.cloud.google')
+    doc = {'name': f'[{i}] ' + chunk['file'], 'url': f"{url}#page={chunk['page']}", 'page': chunk['page'],
+           'snippets': [chunk['text'][:300] + '...']}
+    if REFERENCES == 'full':
+        doc.update({'extracts': [], 'segments': []})
+    return doc
+
+def search_engine_local(history, query, stream=STREAMING):
+    """Retrieves the best matching pages from the local index and lets Gemini answer based on them.
+    
+    Args:
+        query (str): Query from user
+        stream (bool): Stream the answer, see search_engine_grounding
+
+    Returns:
+        dict: {'response': (str) Answer text, 'documents': (list[dict]) List of documents}
+    """
+    with metrics.span('retrieval'):
+        results = get_local_index().search(query, k=5)
+    sources = ''.join(f"[{i}] {chunk['file']}, page {chunk['page']}:\n{chunk['text']}\n\n" for i, (_, chunk) in enumerate(results, start=1))
+    model, contents = prompts.local.prepare(history, query, sources=sources)
+    response = references({'response': ''}, local_document, [chunk for _, chunk in results])
+    if stream:
+        chunks = call_stream('generation', model.generate_content, contents, generation_config=GenerationConfig(temperature=0.0), stream=True)
+        response['stream'] = stream_response(chunks, response)
+        return response
+    with metrics.span('generation'):
+        llm_response = call('generation', model.generate_content, contents, generation_config=GenerationConfig(temperature=0.0))
+    metrics.usage('generation', llm_response)
+    response['response'] = llm_response.text
+    return response
+
+# Retrieval backends, all take (history, query) and return {'response', 'documents'}
+backends = {
+    'grounding': search_engine_grounding,
+    'summary': lambda history, query: search_engine_summary(query),
+    'local': search_engine_local,
+}
+
+def search_engine(history, query):
+    """Answers with the retrieval backend configured in RETRIEVAL"""
+    return backends[RETRIEVAL](history, query)
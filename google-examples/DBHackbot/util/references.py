@@ -20,24 +20,38 @@ def prepare_references():
     if 'references' not in st.session_state:
         st.session_state.references = []
 
-def write_reference(ref):
+def compact_reference(doc):
+    # Only what the sidebar shows is kept in the session
+    ref = {key: doc[key] for key in ('name', 'url', 'page') if key in doc}
+    if doc.get('snippets'):
+        ref['snippets'] = doc['snippets'][:1]
+    return ref
+
+def reference_markdown(ref):
+    parts = []
     if 'name' in ref:
         hlp = ref['name'].split()
         while hlp[1][0].isnumeric():
             hlp[1] = hlp[1][1:]
-        st.markdown(f"[{' '.join(hlp)}]({ref['url']})")
+        parts.append(f"[{' '.join(hlp)}]({ref['url']})")
     if 'page' in ref:
-        st.markdown(f"**[Page {ref['page']}]**")
+        parts.append(f"**[Page {ref['page']}]**")
     if len(ref.get('snippets', [])) > 0:
-        st.markdown(f"*{ref['snippets'][0]}*", unsafe_allow_html=True)
+        parts.append(f"*{ref['snippets'][0]}*")
+    return '\n\n'.join(parts)
+
+def write_reference(ref):
+    st.markdown(reference_markdown(ref), unsafe_allow_html=True)
 
 # display references in the sidebar
+# All references go into a single markdown element of the placeholder. Replacing one element
+# in place works reliably, so a new answer can update the sidebar without rerunning the script.
 def display_references(references = None):
-    global refcounter
     if not references:
         references = st.sidebar.empty()
-    references.empty()
-    with references.container():
-        for ref in st.session_state.references:
-            write_reference(ref)
-    return references
\ No newline at end of file
+    text = '\n\n'.join(reference_markdown(ref) for ref in st.session_state.references)
+    if text:
+        references.markdown(text, unsafe_allow_html=True)
+    else:
+        references.empty()
+    return references
@@ -0,0 +1,67 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Incremental reindexing for create_searchapp.py.
+# Every document gets an id derived from its uri, so it stays the same between runs.
+# A manifest of what was imported last time ({id: {'file', 'uri', 'md5'}}) is kept in the
+# bucket. Comparing it with the current documents tells us what was added, changed or
+# deleted, and only those are sent to the datastore.
+
+import hashlib
+import json
+
+
+def document_id(uri: str) -> str:
+    """Stable document id for a uri (Discovery Engine allows [a-zA-Z0-9-_], max 63 characters)"""
+    return 'doc-' + hashlib.sha1(uri.encode()).hexdigest()
+
+def manifest_entry(bucket_name, name, md5):
+    uri = f'gs://{bucket_name}/{name}'
+    return document_id(uri), {'file': name, 'uri': uri, 'md5': md5}
+
+def diff(old: dict, new: dict):
+    """Compares two manifests.
+
+    Returns:
+        tuple: (added, changed, deleted) lists of document ids
+    """
+    added = [i for i in new if i not in old]
+    changed = [i for i in new if i in old and old[i]['md5'] != new[i]['md5']]
+    deleted = [i for i in old if i not in new]
+    return added, changed, deleted
+
+def metadata_line(doc_id, entry):
+    # {"id":"doc-3","structData":{"title":"test_doc_3"},"content":{"mimeType":"application/pdf","uri":"gs://test-bucket-12345678/test_doc_4.pdf"}}
+    return json.dumps({'id': doc_id,
+                       'structData': {'file': entry['file']},
+                       'content': {'mimeType': 'application/pdf', 'uri': entry['uri']}}) + '\n'
+
+def write_metadata(blob, manifest: dict, ids):
+    """Streams the import metadata (JSONL) for the given documents to a blob, line by line"""
+    with blob.open('w') as f:
+        for doc_id in ids:
+            f.write(metadata_line(doc_id, manifest[doc_id]))
+
+def manifest_name(datastore: str) -> str:
+    """Name of the manifest blob. It is written after every successful import, so its update time is the time of the last import."""
+    return f'manifest_{datastore}.json'
+
+def load_manifest(blob):
+    """The manifest of the last import, None if there is none"""
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_text())
+
+def save_manifest(blob, manifest: dict):
+    blob.upload_from_string(json.dumps(manifest), content_type='application/json')
@@ -0,0 +1,191 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Scheduler for the calls to Gemini and Vertex AI Search, shared by all sessions of the process.
+# At most MAX_CONCURRENT_CALLS calls are in flight, the others wait in a queue:
+#   - interactive calls (a user is waiting) go before background work (history summaries, prefab answers)
+#   - within a priority, sessions take turns, so one busy session can't starve the others
+#   - when MAX_QUEUED_CALLS are waiting, new turns are turned away right away with a friendly message
+# Each session may start SESSION_TURNS_PER_MINUTE turns (bursts of SESSION_BURST).
+# Queue depth, calls in flight and waiting times go to util/metrics.py.
+
+import contextlib
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from util import metrics
+from util.llm import singleton
+from util.settings import MAX_CONCURRENT_CALLS, MAX_QUEUED_CALLS, SESSION_TURNS_PER_MINUTE, SESSION_BURST
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+BUSY = "Lots of people are chatting with me right now and I can't keep up. Please try again in a moment!"
+TOO_FAST = "Whoa, you are asking faster than I can think! Please give me a few seconds."
+
+_session = contextvars.ContextVar('session', default=None)
+_priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+
+
+class Overloaded(Exception):
+    """The queue is full, the message can be shown to the user"""
+    friendly = True
+
+    def __init__(self, message=BUSY):
+        super().__init__(message)
+
+
+@contextlib.contextmanager
+def for_session(session, priority=INTERACTIVE):
+    """Calls in this context (and in threads started with metrics.bind) are queued for this session, with this priority"""
+    token = _session.set(session)
+    priority_token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(priority_token)
+        _session.reset(token)
+
+
+def current_session():
+    return _session.get()
+
+
+def current_priority():
+    return _priority.get()
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+class Scheduler:
+
+    def __init__(self, max_concurrent=16, max_queued=64, turns_per_minute=10, burst=5, max_sessions=10000):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.rate = turns_per_minute / 60
+        self.burst = burst
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.queues = (OrderedDict(), OrderedDict())   # per priority: session -> deque of waiters
+        self.buckets = OrderedDict()                   # session -> (tokens, time)
+
+    def admit(self, session=None):
+        """Checks whether a new turn of the session can start.
+
+        Returns:
+            str: None if it can, otherwise the message for the user
+        """
+        if self.waiting >= self.max_queued:
+            metrics.event('rejected_busy')
+            return BUSY
+        if session is None or self.rate <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(session, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[session] = (tokens - 1 if allowed else tokens, now)
+            while len(self.buckets) > self.max_sessions:
+                self.buckets.popitem(last=False)
+        if not allowed:
+            metrics.event('rejected_rate')
+            return TOO_FAST
+        return None
+
+    def acquire(self, priority=INTERACTIVE, session=None, timeout=None, block=True):
+        """Waits for a free slot.
+
+        Args:
+            priority (int): INTERACTIVE or BACKGROUND
+            session: Session the call belongs to, for fair queuing
+            timeout (float): Seconds to wait at most, raises TimeoutError afterwards
+            block (bool): With False, returns None right away if no slot is free
+
+        Returns:
+            callable: Releases the slot, can be called more than once
+        """
+        start = time.monotonic()
+        with self.lock:
+            if self.running < self.max_concurrent and not self.waiting:
+                self.running += 1
+                return self._release_once()
+            if not block:
+                return None
+            if self.waiting >= self.max_queued:
+                metrics.event('rejected_busy')
+                raise Overloaded()
+            waiter = _Waiter()
+            self.queues[priority].setdefault(session, deque()).append(waiter)
+            self.waiting += 1
+        if not waiter.event.wait(timeout):
+            with self.lock:
+                if not waiter.granted:
+                    waiters = self.queues[priority][session]
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self.queues[priority][session]
+                    self.waiting -= 1
+                    metrics.event('queue_timeout')
+                    raise TimeoutError(f'No free slot within {timeout:.1f}s')
+        metrics.observe('queue_wait', time.monotonic() - start)
+        return self._release_once()
+
+    def _release_once(self):
+        released = []
+        def release():
+            if not released:
+                released.append(True)
+                self._release()
+        return release
+
+    def _release(self):
+        with self.lock:
+            for queue in self.queues:
+                if queue:
+                    # Round robin: the session served goes to the end of the line
+                    session, waiters = queue.popitem(last=False)
+                    waiter = waiters.popleft()
+                    if waiters:
+                        queue[session] = waiters
+                    self.waiting -= 1
+                    # The slot goes straight to the waiter, running stays the same
+                    waiter.granted = True
+                    waiter.event.set()
+                    return
+            self.running -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'running': self.running, 'waiting': self.waiting,
+                    'waiting_interactive': sum(len(w) for w in self.queues[INTERACTIVE].values()),
+                    'waiting_background': sum(len(w) for w in self.queues[BACKGROUND].values())}
+
+
+# One scheduler per process, shared by all sessions
+@singleton
+def get_scheduler():
+    scheduler = Scheduler(MAX_CONCURRENT_CALLS, MAX_QUEUED_CALLS, SESSION_TURNS_PER_MINUTE, SESSION_BURST)
+    metrics.gauge('calls_running', lambda: scheduler.running)
+    metrics.gauge('calls_waiting', lambda: scheduler.waiting)
+    return scheduler
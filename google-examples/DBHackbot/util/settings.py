@@ -25,3 +25,128 @@ REGION = os.getenv("GOOGLE_CLOUD_REGION", 'europe-west1')
 LOCATION = 'eu'
 engine_ds_name = 'db_hackathon_' + PROJECT
 
+
+# Stream answers from Gemini as they are generated ("false" waits for the full answer)
+STREAMING = os.getenv("STREAMING", "true").lower() == "true"
+
+# Speculative answering: start the answer call(s) together with intent detection
+# off:  detect intent first, then answer
+# chat: detect intent and answer with Gemini at the same time, grounding waits for the intent
+# both: detect intent, answer with Gemini and answer with grounding all at the same time
+# chat and both pay for answers that get thrown away whenever the intent goes the other way, hence off by default
+SPECULATION = os.getenv("SPECULATION", "off").lower()
+if SPECULATION not in ('off', 'chat', 'both'):
+    print(f'SPECULATION must be one of off, chat, both - not {SPECULATION}')
+    exit(1)
+
+# Answer cache shared by all sessions: max number of answers and time to live in seconds (0 turns caching off)
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+
+# Token budgets for the chat history in the answer prompts and in the (much simpler) intent prompt
+HISTORY_BUDGET = int(os.getenv("HISTORY_BUDGET", "4000"))
+INTENT_HISTORY_BUDGET = int(os.getenv("INTENT_HISTORY_BUDGET", "500"))
+
+# Create the Google clients in the background at server start instead of on the first question
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+
+# Chat engine as a separate local service (python -m util.engine). If ENGINE_URL is set,
+# the Streamlit UI sends questions there instead of answering them in its own process.
+ENGINE_PORT = int(os.getenv("ENGINE_PORT", "8081"))
+ENGINE_URL = os.getenv("ENGINE_URL", "")
+
+# Number of chat messages shown, older ones are loaded on request
+CHAT_WINDOW = int(os.getenv("CHAT_WINDOW", "20"))
+
+# Prefab questions, shown as buttons on a fresh session, separated by |. Their answers are computed
+# at server start and again every PREFAB_REFRESH seconds (0: no precomputed answers, clicks are answered like any question)
+PREFAB_QUESTIONS = [q.strip() for q in os.getenv("PREFAB_QUESTIONS",
+    "How fast is an elephant?|Tell me a Chuck Norris joke|What is the business model of alphabet?").split('|') if q.strip()]
+PREFAB_REFRESH = int(os.getenv("PREFAB_REFRESH", "3600"))
+
+# Retrieval backend for alphabet questions:
+# grounding: Gemini grounded on Vertex AI Search, summary: Vertex AI Search summary,
+# local: local index over the pdfs (python -m util.local_search build)
+RETRIEVAL = os.getenv("RETRIEVAL", "grounding").lower()
+if RETRIEVAL not in ('grounding', 'summary', 'local'):
+    print(f'RETRIEVAL must be one of grounding, summary, local - not {RETRIEVAL}')
+    exit(1)
+
+# References of retrieval answers:
+# lazy: the answer is returned right away, the documents are built in the background with only
+#       what the sidebar shows (name, url, page, first snippet)
+# full: all documents with all snippets, extracts and segments are built before the answer is returned
+REFERENCES = os.getenv("REFERENCES", "lazy").lower()
+if REFERENCES not in ('lazy', 'full'):
+    print(f'REFERENCES must be one of lazy, full - not {REFERENCES}')
+    exit(1)
+
+# Latency tracing and metrics (util/metrics.py): every turn is logged as one JSON line with the
+# time spent per stage. METRICS_PORT serves /metrics for Prometheus from the Streamlit process
+# (0: no exporter, the engine service always has /metrics).
+TRACING = os.getenv("TRACING", "false").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Deadlines for the remote calls (util/calls.py). A turn gets TURN_DEADLINE seconds, every call
+# at most its stage timeout of what is left (streams: until the first chunk arrives).
+# Retryable errors are retried CALL_RETRIES times, with HEDGING a slow call gets a duplicate
+# once it takes longer than 95% of the recent calls of its stage.
+# With less than DEGRADE_BELOW seconds left when the search would start, it is skipped and Gemini answers directly.
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "40"))
+CALL_TIMEOUTS = {stage: float(os.getenv(f"{stage.upper()}_TIMEOUT", default))
+                 for stage, default in (('intent', '5'), ('retrieval', '10'), ('generation', '20'), ('generation_image', '30'), ('grounding', '25'), ('summary', '30'), ('context_cache', '10'))}
+CALL_RETRIES = int(os.getenv("CALL_RETRIES", "2"))
+HEDGING = os.getenv("HEDGING", "true").lower() == "true"
+DEGRADE_BELOW = float(os.getenv("DEGRADE_BELOW", "10"))
+
+# Model side caching of the static prompt preambles (util/prompts.py): off, vertex or local (a stand-in for tests).
+# Vertex AI only caches prefixes of at least 32768 tokens, shorter preambles are sent as usual.
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "off").lower()
+if CONTEXT_CACHE not in ('off', 'vertex', 'local'):
+    print(f'CONTEXT_CACHE must be one of off, vertex, local - not {CONTEXT_CACHE}')
+    exit(1)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "32768"))
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+
+# Scheduler for the calls to Gemini and Vertex AI Search (util/scheduler.py): calls in flight,
+# calls waiting before new turns are turned away, and turns per session and minute (with bursts)
+MAX_CONCURRENT_CALLS = int(os.getenv("MAX_CONCURRENT_CALLS", "16"))
+MAX_QUEUED_CALLS = int(os.getenv("MAX_QUEUED_CALLS", "64"))
+SESSION_TURNS_PER_MINUTE = float(os.getenv("SESSION_TURNS_PER_MINUTE", "10"))
+SESSION_BURST = int(os.getenv("SESSION_BURST", "5"))
+
+# Micro-batching of intent detection: LLM intent requests arriving within INTENT_BATCH_WINDOW_MS
+# milliseconds are classified in one call, up to INTENT_BATCH_SIZE at a time
+INTENT_BATCHING = os.getenv("INTENT_BATCHING", "false").lower() == "true"
+INTENT_BATCH_SIZE = int(os.getenv("INTENT_BATCH_SIZE", "16"))
+INTENT_BATCH_WINDOW_MS = float(os.getenv("INTENT_BATCH_WINDOW_MS", "5"))
+
+# Cache for search results (util/rag.py), separate from the answer cache: max entries in memory,
+# time to live in seconds (0 turns it off) and an optional SQLite file shared by processes and restarts.
+# Entries written before the last datastore import are ignored, the import time is checked every
+# RETRIEVAL_CACHE_CHECK seconds.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1000"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "21600"))
+RETRIEVAL_CACHE_DB = os.getenv("RETRIEVAL_CACHE_DB", "")
+RETRIEVAL_CACHE_CHECK = int(os.getenv("RETRIEVAL_CACHE_CHECK", "60"))
+
+# Chat transcripts (util/messages.py): SQLite file all messages are logged to ('', the default, keeps them
+# in memory only) and the memory per session for the newest messages, older ones are read back from the file when needed
+# (without a file they are dropped).
+# Logged messages are deleted after SESSION_RETENTION_DAYS (0 keeps them).
+# Session ids in the url are signed with SESSION_SECRET, set it so that links survive a restart.
+SESSION_STORE = os.getenv("SESSION_STORE", "")
+SESSION_MEMORY_KB = int(os.getenv("SESSION_MEMORY_KB", "32"))
+SESSION_RETENTION_DAYS = float(os.getenv("SESSION_RETENTION_DAYS", "30"))
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+
+# Images sent with a question (util/images.py) are scaled to at most IMAGE_MAX_SIDE pixels and re-encoded
+# as JPEG with IMAGE_QUALITY. Preprocessed images are cached by content for all sessions, up to IMAGE_CACHE_MB.
+# Uploads of more than IMAGE_MAX_MB are refused.
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "64"))
+IMAGE_MAX_MB = int(os.getenv("IMAGE_MAX_MB", "20"))
+if not 1 <= IMAGE_QUALITY <= 95:
+    print(f'IMAGE_QUALITY must be between 1 and 95 - not {IMAGE_QUALITY}')
+    exit(1)
@@ -0,0 +1,214 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import queue
+from concurrent.futures import Future
+import threading
+import time
+from util import metrics
+
+# Helpers for streaming answers from Gemini.
+# With stream=True generate_content returns an iterator of partial responses.
+# We hand out the text of each chunk as soon as it arrives and collect
+# everything else (e.g. grounding metadata) once the stream has ended.
+# Nothing in here depends on Vertex AI, so any iterable of objects with a
+# `.text` attribute (like a local fake model) can be streamed.
+
+
+def chunk_text(chunk) -> str:
+    """Returns the text of a streamed chunk or '' if the chunk has none (e.g. metadata only)."""
+    try:
+        return chunk.text or ''
+    except (ValueError, AttributeError, IndexError):
+        return ''
+
+
+def stream_response(chunks, response: dict, on_end=None, stage='generation'):
+    """Yields answer text as it arrives and fills the response dict on the way.
+
+    Args:
+        chunks (iterable): Partial responses from generate_content(..., stream=True)
+        response (dict): Response dict, 'response' is extended with every chunk
+        on_end (callable): Optional, called with the list of all chunks after the stream ended.
+            Whatever it returns (a dict) is merged into response.
+        stage (str): Name of the stage in the metrics, time to the first text is recorded as <stage>_first_text
+
+    Yields:
+        str: Text of each chunk
+    """
+    received = []
+    start = time.perf_counter()
+    first = True
+    try:
+        for chunk in chunks:
+            received.append(chunk)
+            text = chunk_text(chunk)
+            if text:
+                if first:
+                    metrics.observe(f'{stage}_first_text', time.perf_counter() - start)
+                    first = False
+                response['response'] += text
+                yield text
+    except Exception as e:
+        metrics.error(stage, e)
+        # Some errors come with a message meant for the user (e.g. util.scheduler.Overloaded)
+        text = str(e) if getattr(e, 'friendly', False) else f'\nOh no! A problem occurred:\n{str(e)}\n'
+        response['error'] = True
+        response['response'] += text
+        yield text
+    metrics.observe(stage, time.perf_counter() - start)
+    if received:
+        # The usage of the whole answer comes with the last chunk
+        metrics.usage(stage, received[-1])
+    if on_end:
+        response.update(on_end(received))
+
+
+def when_done(response: dict, callback):
+    """Calls callback(response) once the answer is complete: right away, or when a streaming response's stream is exhausted"""
+    if 'stream' not in response:
+        callback(response)
+        return response
+    stream = response['stream']
+    def then_call():
+        yield from stream
+        callback(response)
+    response['stream'] = then_call()
+    return response
+
+
+def hydrate(response: dict, build, items, submit) -> dict:
+    """Builds the documents of a response in the background, so the answer doesn't wait for them.
+    response['references'] gets one future per item, in order, each is done as soon as its document is
+    built; response['documents'] is filled in by documents() once they are all done.
+
+    Args:
+        build (callable): build(i, item) returns the document for the i-th item (counting from 1)
+        submit (callable): Runs a function in the background, e.g. the submit of a ThreadPoolExecutor
+    """
+    items = list(items)
+    futures = [Future() for _ in items]
+    def build_all():
+        # One background job for all of them, the documents are small
+        with metrics.span('documents'):
+            for i, (item, future) in enumerate(zip(items, futures), start=1):
+                try:
+                    future.set_result(build(i, item))
+                except Exception as e:
+                    future.set_exception(e)
+    response['documents'] = []
+    response['references'] = futures
+    if items:
+        submit(metrics.bind(build_all))
+    return response
+
+def documents(response: dict) -> list:
+    """The documents of a response, waits for the ones still being built (see hydrate). Failed ones are left out."""
+    futures = response.get('references')
+    if futures:
+        docs = []
+        for future in futures:
+            if future.exception() is None:
+                docs.append(future.result())
+            else:
+                metrics.error('documents', future.exception())
+        response['documents'] = docs
+    return response.get('documents', [])
+
+def when_hydrated(response: dict, callback):
+    """Like when_done, but also waits until the documents built in the background are there.
+    The callback then runs in the thread that built the last of them."""
+    def then_hydrate(response):
+        futures = response.get('references')
+        if not futures:
+            callback(response)
+            return
+        pending = [len(futures)]
+        lock = threading.Lock()
+        def one_done(_):
+            with lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                documents(response)
+                callback(response)
+        for future in futures:
+            future.add_done_callback(one_done)
+    return when_done(response, then_hydrate)
+
+
+def started(response: dict) -> bool:
+    """Waits for the first text of a streaming response, the stream then starts with it again.
+    Streams are lazy, so this is the point where a failing request shows.
+
+    Returns:
+        bool: False if the answer failed before any text came
+    """
+    stream = response.get('stream')
+    if stream is None:
+        return not response.get('error')
+    first = next(stream, None)
+    if response.get('error'):
+        return False
+    response['stream'] = itertools.chain([first] if first is not None else [], stream)
+    return True
+
+
+def consume(response: dict) -> dict:
+    """Drains a streaming response, so callers that want the full answer can get it."""
+    for _ in response.pop('stream', []):
+        pass
+    return response
+
+
+_END = object()
+
+def prefetch(response: dict) -> dict:
+    """Starts pulling a streaming response in a background thread.
+
+    Streams from generate_content are lazy: the request is only sent when somebody iterates.
+    For speculative answers we want generation to start right away, so chunks are buffered
+    here and handed out later through a new response['stream'].
+    response['stop'] is set to a function that drops the rest of the stream.
+    """
+    stream = response.get('stream')
+    if stream is None:
+        return response
+    buffer = queue.Queue()
+    stop = threading.Event()
+
+    def pull():
+        try:
+            for text in stream:
+                if stop.is_set():
+                    break
+                buffer.put(text)
+        finally:
+            buffer.put(_END)
+
+    def drain():
+        while (text := buffer.get()) is not _END:
+            yield text
+
+    threading.Thread(target=metrics.bind(pull), daemon=True).start()
+    response['stream'] = drain()
+    response['stop'] = stop.set
+    return response
+
+
+def discard(response: dict):
+    """Drops a response we are not going to use. A prefetched stream stops pulling chunks."""
+    if 'stop' in response:
+        response['stop']()
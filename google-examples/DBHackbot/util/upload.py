@@ -0,0 +1,145 @@
+# Copyright 2024 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Document upload for create_searchapp.py.
+# Files are uploaded by a pool of workers. A file whose MD5 matches the blob already in
+# the bucket is skipped, so an interrupted run simply continues where it stopped when
+# started again. Works with a google.cloud.storage bucket or with LocalBucket, a stand-in
+# that keeps the "bucket" in a local directory.
+
+import base64
+import hashlib
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Files larger than this are uploaded in chunks with a resumable upload
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def md5_base64(path):
+    """MD5 of a file, base64 encoded like Blob.md5_hash"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+def existing_hashes(bucket):
+    """{blob name: md5} of everything in the bucket"""
+    return {blob.name: blob.md5_hash for blob in bucket.list_blobs(fields='items(name,md5Hash),nextPageToken')}
+
+def upload_file(bucket, name, path, existing_md5=None):
+    """Uploads a file unless the blob already has the same content. Returns the number of bytes uploaded or None if skipped."""
+    if existing_md5 and existing_md5 == md5_base64(path):
+        return None
+    blob = bucket.blob(name)
+    if os.path.getsize(path) > RESUMABLE_CHUNK_SIZE:
+        blob.chunk_size = RESUMABLE_CHUNK_SIZE
+    blob.upload_from_filename(path, checksum='md5')
+    return os.path.getsize(path)
+
+def upload_directory(bucket, docdir, names, workers=8):
+    """Uploads the files from docdir that are missing or changed in the bucket.
+
+    Args:
+        bucket: google.cloud.storage Bucket or LocalBucket
+        docdir (str): Local directory with the files
+        names (list[str]): Files to upload
+        workers (int): Number of parallel uploads
+
+    Returns:
+        dict: {'uploaded': int, 'skipped': int, 'failed': int, 'bytes': int, 'seconds': float}
+    """
+    start = time.perf_counter()
+    existing = existing_hashes(bucket)
+    stats = {'uploaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    # Hashing and uploading both happen in the workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload_file, bucket, name, os.path.join(docdir, name), existing.get(name)): name for name in names}
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                stats['failed'] += 1
+                print(f'ERROR uploading {name}: {e}')
+                continue
+            if size is None:
+                stats['skipped'] += 1
+                continue
+            stats['bytes'] += size
+            stats['uploaded'] += 1
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(names)}] uploaded {name} - {stats['bytes'] / 1024 / 1024 / elapsed:.1f} MB/s")
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+class LocalBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def md5_hash(self):
+        return md5_base64(self.path) if os.path.exists(self.path) else None
+
+    def upload_from_filename(self, filename, checksum=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write to a temporary file first, an interrupted copy must not look like a finished upload
+        shutil.copyfile(filename, self.path + '.part')
+        os.replace(self.path + '.part', self.path)
+
+    def upload_from_string(self, data, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+
+    def open(self, mode='r'):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, mode)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def download_as_text(self):
+        with open(self.path) as f:
+            return f.read()
+
+
+class LocalBucket:
+    """Stand-in for a google.cloud.storage Bucket, backed by a local directory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.name = os.path.basename(os.path.normpath(root))
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, fields=None):
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                if not file.endswith('.part'):
+                    yield LocalBlob(self, os.path.relpath(os.path.join(directory, file), self.root))